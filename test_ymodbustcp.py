@@ -0,0 +1,450 @@
+"""
+ymodbustcp unit tests, run with::
+
+    python -m pytest -q
+"""
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from pymodbus.constants import Endian
+from pymodbus.payload import BinaryPayloadBuilder
+
+import ymodbusbench
+import ymodbustcp
+
+
+def make_binding(reg, refresh=1.0):
+    return ymodbustcp.YocotpuceBinding(reg, "TEST%05d.genericSensor1" % reg, 'int16',
+                                       refresh=refresh, backend='sim')
+
+
+class EncodingTest(unittest.TestCase):
+
+    ORDERS = {'big': Endian.Big, 'little': Endian.Little}
+    BUILDERS = {
+        'int8': ('add_8bit_int', int),
+        'int16': ('add_16bit_int', int),
+        'int32': ('add_32bit_int', int),
+        'float16': ('add_16bit_float', float),
+        'float32': ('add_32bit_float', float),
+    }
+
+    def test_payload_builder_parity(self):
+        """ The struct encoders produce the registers of the pymodbus
+        payload builder, for every encoding, byte and word order
+        """
+        for encoding in sorted(ymodbustcp.ENCODINGS):
+            add, convert = self.BUILDERS[encoding]
+            for byteorder in self.ORDERS:
+                for wordorder in self.ORDERS:
+                    binding = ymodbustcp.YocotpuceBinding(
+                        0, "TEST.genericSensor1", encoding, byteorder=byteorder,
+                        wordorder=wordorder, backend='sim')
+                    for val in (0, 21.5, -3, 100, -128):
+                        builder = BinaryPayloadBuilder(byteorder=self.ORDERS[byteorder],
+                                                       wordorder=self.ORDERS[wordorder])
+                        getattr(builder, add)(convert(val))
+                        expected = builder.to_registers()
+                        self.assertEqual(binding.encode_value(val), expected,
+                                         (encoding, byteorder, wordorder, val))
+                        if byteorder == wordorder == 'big':
+                            self.assertEqual(expected, ymodbusbench.legacy_encode(encoding, val))
+                        registers = [0] * (binding.get_reglen() + 2)
+                        binding.encode_into(registers, 1, val)
+                        self.assertEqual(registers, [0] + expected + [0])
+
+
+class OverlappingTest(unittest.TestCase):
+
+    def check_overlapping(self, bindings):
+        block = ymodbustcp.YoctopuceDataBlock(dict((binding.reg_addr, binding)
+                                                   for binding in bindings))
+        end = max(binding.reg_addr + binding.get_reglen() for binding in bindings)
+        for address in range(end + 2):
+            for count in (1, 2, 3, 7, 125):
+                expected = sorted((binding for binding in bindings
+                                   if binding.overlaps(address, count)),
+                                  key=lambda binding: binding.reg_addr)
+                self.assertEqual(block.overlapping(address, count), expected, (address, count))
+
+    def test_disjoint(self):
+        """ The interval index finds the bindings of a linear scan, on a
+        map with gaps
+        """
+        self.check_overlapping([
+            ymodbustcp.YocotpuceBinding(reg, "TEST%d.genericSensor1" % reg, encoding,
+                                        backend='sim')
+            for reg, encoding in ((0, 'int16'), (1, 'float32'), (5, 'int32'), (20, 'int8'))])
+
+    def test_overlapping(self):
+        """ Same on a map declaring overlapping bindings
+        """
+        self.check_overlapping([
+            ymodbustcp.YocotpuceBinding(reg, "TEST%d.genericSensor1" % reg, encoding,
+                                        backend='sim')
+            for reg, encoding in ((0, 'float32'), (1, 'int16'), (2, 'int32'), (3, 'float32'),
+                                  (10, 'int16'))])
+
+
+class SparseBlockTest(unittest.TestCase):
+
+    def test_reads_across_gaps(self):
+        """ A sparse block reads as the dense one, the registers between
+        its segments as 0
+        """
+        def build():
+            devices = {}
+            for reg, encoding in ((0, 'int16'), (3, 'float32'), (40, 'int32'),
+                                  (300, 'int16'), (301, 'int16'), (1000, 'float32')):
+                devices[reg] = ymodbustcp.YocotpuceBinding(
+                    reg, "TEST%d.genericSensor1" % reg, encoding, backend='sim')
+            return devices
+
+        dense_devices, sparse_devices = build(), build()
+        dense = ymodbustcp.YoctopuceDataBlock(dense_devices)
+        sparse = ymodbustcp.YoctopuceSparseBlock(sparse_devices)
+        for block, devices in ((dense, dense_devices), (sparse, sparse_devices)):
+            block.store_many([(binding, reg + 1) for reg, binding in devices.items()])
+        self.assertIsInstance(ymodbustcp.create_block(build()), ymodbustcp.YoctopuceSparseBlock)
+        for address in list(range(0, 60)) + list(range(250, 320)) + list(range(900, 1002)):
+            for count in (1, 2, 5, 125):
+                if not dense.validate(address, count):
+                    continue
+                self.assertTrue(sparse.validate(address, count))
+                self.assertEqual(sparse.getValues(address, count),
+                                 dense.getValues(address, count), (address, count))
+        self.assertEqual(sparse.getValues(41, 10), [41, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+
+
+class SimulatedSensorTest(unittest.TestCase):
+
+    def test_offline_flag(self):
+        """ offline is parsed as the other flags of the device map
+        """
+        for flag, offline in (('1', True), ('yes', True), ('on', True),
+                              ('0', False), ('no', False), ('off', False)):
+            sensor = ymodbustcp.SimulatedSensor("SIM.genericSensor1", "offline=" + flag)
+            self.assertEqual(sensor.offline, offline, flag)
+
+
+class StoreTest(unittest.TestCase):
+
+    def check_out_of_range(self, kind):
+        bindings = {0: make_binding(0), 1: make_binding(1)}
+        block = kind(bindings)
+        block.store_many([(binding, 7) for binding in bindings.values()])
+        timestamp = bindings[0].timestamp
+        block.store_many([(bindings[0], 40000), (bindings[1], 5)])
+        self.assertEqual(block.getValues(1, 1), [5])
+        self.assertEqual(bindings[0].value, 7)
+        self.assertEqual(bindings[0].timestamp, timestamp)
+        self.assertTrue(bindings[0].read_failed)
+        self.assertEqual(block.getValues(0, 1), [7])
+
+    def test_out_of_range_list(self):
+        """ A value its encoding cannot hold is a failed read, which does
+        not stop the pass
+        """
+        self.check_out_of_range(ymodbustcp.YoctopuceDataBlock)
+
+    def test_out_of_range_image(self):
+        """ Same for a pass packing the whole image, which keeps its
+        registers
+        """
+        self.check_out_of_range(ymodbustcp.YoctopuceImageBlock)
+
+    def test_out_of_range_snapshot(self):
+        """ Same for a snapshot block, which publishes the others
+        """
+        self.check_out_of_range(ymodbustcp.YoctopuceSnapshotBlock)
+
+
+class YoctopuceStoreTest(unittest.TestCase):
+
+    def make_store(self, lines, **kwargs):
+        handle, path = tempfile.mkstemp(suffix='.txt')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, 'w') as stream:
+            stream.write('\n'.join(lines) + '\n')
+        return path, ymodbustcp.YoctopuceStore(path, backend='sim', **kwargs)
+
+    def test_actuators_only(self):
+        """ A map, or a unit, of actuators only has an empty measure block
+        """
+        for lines in (["0x0010,RELAY.relay1,relay"],
+                      ["0x0000,METEO.temperature,int16,unit=1",
+                       "0x0010,RELAY.relay1,relay,unit=2"]):
+            for image in (False, True):
+                path, store = self.make_store(lines, image=image)
+                slave = store.context[2 if len(lines) > 1 else 1]
+                self.assertEqual(slave.getValues(3, 0x10, 1), [0])
+                self.assertFalse(slave.validate(4, 0, 1))
+
+    def test_reload_keeps_values(self):
+        """ A reload keeps the binding, hence the cached value, of the
+        lines that did not change
+        """
+        path, store = self.make_store(["0x0000,METEO.temperature,int16,refresh=60"])
+        store.start()
+        self.addCleanup(lambda: ymodbustcp.stop_workers(store.workers))
+        binding = store.current.units[1].devices[0]
+        timestamp = binding.timestamp
+        self.assertIsNotNone(timestamp)
+        with open(path, 'a') as stream:
+            stream.write("0x0001,METEO.humidity,int16,refresh=60\n")
+        store.reload()
+        devices = store.current.units[1].devices
+        self.assertIs(devices[0], binding)
+        self.assertEqual(binding.timestamp, timestamp)
+        self.assertIsNotNone(devices[1].timestamp)
+        self.assertEqual(store.context[1].getValues(3, 0, 1), binding.encode_value(binding.value))
+
+    def test_reload_units(self):
+        """ A reload adds and removes units
+        """
+        path, store = self.make_store(["0x0000,METEO.temperature,int16,unit=1",
+                                       "0x0000,LIGHT.lightSensor,int16,unit=2"])
+        store.start()
+        self.addCleanup(lambda: ymodbustcp.stop_workers(store.workers))
+        self.assertEqual(sorted(store.context.slaves()), [1, 2])
+        with open(path, 'w') as stream:
+            stream.write("0x0000,METEO.temperature,int16,unit=1\n"
+                         "0x0004,RELAY.relay1,relay,unit=3\n")
+        store.reload()
+        self.assertEqual(sorted(store.context.slaves()), [1, 3])
+        self.assertRaises(ymodbustcp.NoSuchSlaveException, lambda: store.context[2])
+        self.assertEqual(store.context[3].getValues(3, 4, 1), [0])
+
+    def test_reload_unit_column(self):
+        """ Adding the unit column requires a restart, the map is kept
+        """
+        path, store = self.make_store(["0x0000,METEO.temperature,int16"])
+        store.start()
+        self.addCleanup(lambda: ymodbustcp.stop_workers(store.workers))
+        current = store.current
+        with open(path, 'w') as stream:
+            stream.write("0x0000,METEO.temperature,int16,unit=2\n")
+        store.reload()
+        self.assertIs(store.current, current)
+
+    def test_reload_processes(self):
+        """ A reload stops the acquisition processes, which hold their
+        hub, before starting the new ones
+        """
+        path, store = self.make_store(["0x0000,METEO.temperature,int16"],
+                                      acquisition='process')
+        store.start()
+        self.addCleanup(lambda: ymodbustcp.stop_workers(store.workers))
+        old = list(store.workers)
+        alive = []
+        start = ymodbustcp.YoctopuceProcess.start
+
+        def check_start(worker):
+            alive.extend(process._process.is_alive() for process in old)
+            start(worker)
+
+        with open(path, 'a') as stream:
+            stream.write("0x0001,METEO.humidity,int16\n")
+        ymodbustcp.YoctopuceProcess.start = check_start
+        try:
+            store.reload()
+        finally:
+            ymodbustcp.YoctopuceProcess.start = start
+        self.assertEqual(alive, [False])
+        self.assertEqual(len(store.current.units[1].devices), 2)
+        self.assertTrue(all(worker.ready.is_set() for worker in store.workers))
+
+
+class PrefetchScheduleTest(unittest.TestCase):
+
+    def test_jittery_master(self):
+        """ A master reading every second, then with +-12% jitter, must
+        not make a pass pop the same binding twice nor schedule it before
+        the pass, whose 50 ms grow the prefetch lead
+        """
+        binding = make_binding(0)
+        cadence = ymodbustcp.ReadCadence()
+        schedule = ymodbustcp.PollSchedule({0: binding}, cadence=cadence)
+        intervals = [1.0] * 5 + [0.88, 1.12] * 15
+        errors = []
+
+        def run():
+            now = schedule._heap[0][0] - 1
+            read = now
+            while intervals:
+                now += 0.01
+                if now >= read:
+                    cadence.observe(0, 1, now, [binding])
+                    read = now + intervals.pop(0)
+                batch = schedule.pop_due(now)
+                if len(batch) > 1 or schedule._heap[0][0] <= now:
+                    errors.append("rescheduled at %r at %r" % (schedule._heap[0][0], now))
+                    return
+                if batch:
+                    now += 0.05
+                    schedule.record_pass(now)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), "pop_due does not return")
+        self.assertEqual(errors, [])
+
+    def test_full_cadence_table(self):
+        """ One-off ranges filling the table do not prevent learning the
+        period of a master
+        """
+        binding = make_binding(0)
+        cadence = ymodbustcp.ReadCadence()
+        now = 1000.0
+        for address in range(ymodbustcp.MAX_CADENCE_RANGES + 10):
+            now += 0.001
+            cadence.observe(address, 1, now, [])
+        for _ in range(ymodbustcp.CADENCE_SAMPLES + 2):
+            now += 1
+            cadence.observe(0, 2, now, [binding])
+        self.assertAlmostEqual(cadence.next_read(binding, now), now + 1, places=6)
+        self.assertLessEqual(len(cadence._ranges), ymodbustcp.MAX_CADENCE_RANGES)
+
+    def test_prefetch_before_read(self):
+        """ A steady master gets its range refreshed before its next read
+        """
+        binding = make_binding(0, refresh=10)
+        cadence = ymodbustcp.ReadCadence()
+        schedule = ymodbustcp.PollSchedule({0: binding}, cadence=cadence)
+        now = 1000.0
+        for _ in range(ymodbustcp.CADENCE_SAMPLES + 2):
+            now += 0.3
+            cadence.observe(0, 1, now, [binding])
+        expected = cadence.next_read(binding, now)
+        self.assertAlmostEqual(expected, now + 0.3, places=6)
+        schedule._heap[:] = [(now, 0, 0)]
+        self.assertEqual(schedule.pop_due(now), [binding])
+        self.assertGreater(schedule._heap[0][0], now)
+        self.assertLess(schedule._heap[0][0], expected)
+
+
+class BindingGroupTest(unittest.TestCase):
+
+    def test_refresh_period_follows_bindings(self):
+        """ A refresh period written to a binding changes the period of
+        its group
+        """
+        bindings = [make_binding(0, 0.5), make_binding(1, 2)]
+        group = ymodbustcp.BindingGroup(bindings)
+        self.assertEqual(group.refresh_period, 0.5)
+        bindings[0].refresh_period = 5.0
+        self.assertEqual(group.refresh_period, 2.0)
+
+
+class SharedBlockTest(unittest.TestCase):
+
+    def test_writer_dead_in_a_write(self):
+        """ A record left locked by a writer fails the reads rather than
+        spinning forever
+        """
+        bindings = {0: make_binding(0), 1: make_binding(1)}
+        block = ymodbustcp.YoctopuceSharedBlock(bindings)
+        self.addCleanup(block.close)
+        block.store_many([(binding, 7) for binding in bindings.values()])
+        self.assertEqual(block.getValues(0, 2), [7, 7])
+        ymodbustcp.RECORD_SEQ.pack_into(block.shared.buf, block.shared._records + ymodbustcp.RECORD_SIZE, 1)
+        self.assertRaises(ymodbustcp.TornReadError, block.getValues, 0, 2)
+        self.assertRaises(ymodbustcp.TornReadError, block.prepare, 1)
+
+
+class EventPumpTest(unittest.TestCase):
+
+    def test_ready_once_acquired(self):
+        """ The event acquisition is ready once every sensor pushed a value
+        """
+        bindings = {0: make_binding(0), 1: make_binding(1)}
+        block = ymodbustcp.YoctopuceImageBlock(bindings)
+        pump = ymodbustcp.YoctopuceEventPump([block])
+        pump.start()
+        self.addCleanup(pump.join)
+        self.addCleanup(pump.stop)
+        self.assertTrue(pump.ready.wait(5))
+        for binding in bindings.values():
+            self.assertIsNotNone(binding.timestamp)
+
+    def test_unplugged_module(self):
+        """ The cached responses of an unplugged module are not served
+        """
+        class Module(object):
+            def get_serialNumber(self):
+                return "TEST00000"
+
+        bindings = {0: make_binding(0), 1: make_binding(1)}
+        block = ymodbustcp.YoctopuceImageBlock(bindings)
+        block.store_many([(binding, 7) for binding in bindings.values()])
+        cache = ymodbustcp.ResponseCache(block)
+        pump = ymodbustcp.YoctopuceEventPump([block])
+        for binding in bindings.values():
+            binding.get_serial()
+        self.assertEqual(cache.read(3, 0, 2), cache.read(3, 0, 2))
+        pump._removed(Module())
+        self.assertRaises(ymodbustcp.StaleMeasureError, cache.read, 3, 0, 2)
+
+
+class WriterTest(unittest.TestCase):
+
+    def test_write_before_read_back(self):
+        """ The read back of a new actuator does not overwrite a write
+        submitted before it
+        """
+        actuator = ymodbustcp.YoctopuceActuator(0x10, "RELAY.relay1", 'relay', backend='sim')
+        function = actuator._read.__self__
+        function.value = 1
+        writer = ymodbustcp.YoctopuceWriter({0x10: actuator})
+        writer.submit(actuator, 0)
+        writer.start()
+        self.addCleanup(writer.join)
+        self.addCleanup(writer.stop)
+        for _ in range(100):
+            if not writer._pending and not writer._loading:
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.assertEqual(function.value, 0)
+        self.assertEqual(actuator.value, 0)
+
+
+class FastReadPathTest(unittest.TestCase):
+
+    class Transport(object):
+
+        def __init__(self):
+            self.written = []
+
+        def write(self, data):
+            self.written.append(bytes(data))
+
+        def get_write_buffer_size(self):
+            return 0
+
+    def test_frames_after_deferred_frame(self):
+        """ The frames received after one left to pymodbus are left to it
+        too, so that the responses keep the order of the requests
+        """
+        bindings = {0: make_binding(0), 1: make_binding(1)}
+        block = ymodbustcp.YoctopuceImageBlock(bindings)
+        block.store_many([(binding, 7) for binding in bindings.values()])
+        context = ymodbustcp.ModbusServerContext(
+            slaves=ymodbustcp.build_slave_context(block), single=True)
+        transport = self.Transport()
+        fast = ymodbustcp.FastReadPath(context, transport)
+        read = struct.pack('>HHHBBHH', 1, 0, 6, 1, 3, 0, 2)
+        write = struct.pack('>HHHBBHH', 2, 0, 6, 1, 6, 0, 5)
+        second_read = struct.pack('>HHHBBHH', 3, 0, 6, 1, 3, 0, 2)
+        others = fast.feed(read + write + second_read[:5])
+        self.assertEqual(transport.written, [struct.pack('>HHHBBBHH', 1, 0, 7, 1, 3, 4, 7, 7)])
+        self.assertEqual(bytes(others), write + second_read[:5])
+
+
+if __name__ == "__main__":
+    unittest.main()
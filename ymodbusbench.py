@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+"""
+ymodbustcp benchmarks
+--------------------------------------------------------------------------
+
+Micro benchmarks for the hot paths of the ymodbustcp server and a Modbus
+TCP load generator. Each benchmark is a sub command, for instance::
+
+    ./ymodbusbench.py lookup
+    ./ymodbusbench.py server --clients 50 --pattern random
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from pymodbus.constants import Endian
+from pymodbus.payload import BinaryPayloadBuilder
+
+import ymodbustcp
+
+
+def build_map(size, encoding='float32'):
+    """ Build a device map of size fresh bindings packed one after the
+    other, as YoctopuceStore.build would.
+    """
+    devices = {}
+    reg = 0
+    for i in range(size):
+        binding = ymodbustcp.YocotpuceBinding(reg, "BENCH%05d.genericSensor1" % i, encoding,
+                                              backend='sim')
+        binding.timestamp = time.monotonic()
+        devices[reg] = binding
+        reg += binding.get_reglen()
+    return devices
+
+
+def changing_passes(measures):
+    """ Return an endless cycle of two acquisition passes of measures with
+    different values, so that no sample is skipped as unchanged
+    """
+    shifted = [(binding, val + 1e-3) for binding, val in measures]
+    return itertools.cycle((shifted, measures))
+
+
+def map_end(devices):
+    return max(reg + binding.get_reglen() for reg, binding in devices.items())
+
+
+def report(name, seconds, number):
+    print("%-40s %10.3f us/op" % (name, seconds * 1e6 / number))
+
+
+# --------------------------------------------------------------------------- #
+# register range lookup
+# --------------------------------------------------------------------------- #
+
+
+def bench_lookup(args):
+    """ Compare the cost of finding the bindings overlapping a 2 register
+    read with the interval index and with a scan of every binding.
+    """
+    for size in (10, 100, 1000, 10000):
+        block = ymodbustcp.YoctopuceDataBlock(build_map(size))
+        bindings = list(block.devices.values())
+        end = map_end(block.devices)
+        addresses = [random.randrange(block.address, end - 1) for _ in range(1000)]
+
+        def indexed():
+            for address in addresses:
+                block.overlapping(address, 2)
+
+        def scanned():
+            for address in addresses:
+                [b for b in bindings if b.overlaps(address, 2)]
+
+        number = len(addresses) * args.repeat
+        report("index lookup, %d bindings" % size,
+               timeit.timeit(indexed, number=args.repeat), number)
+        report("linear scan, %d bindings" % size,
+               timeit.timeit(scanned, number=args.repeat), number)
+
+
+# --------------------------------------------------------------------------- #
+# value encoding
+# --------------------------------------------------------------------------- #
+
+
+def legacy_encode(encoding, val):
+    """ The per call payload builder encoding ymodbustcp used to do """
+    builder = BinaryPayloadBuilder(byteorder=Endian.Big)
+    if encoding == 'int8':
+        builder.add_8bit_int(int(val))
+    elif encoding == 'int16':
+        builder.add_16bit_int(int(val))
+    elif encoding == 'int32':
+        builder.add_32bit_int(int(val))
+    elif encoding == 'float16':
+        builder.add_16bit_float(val)
+    elif encoding == 'float32':
+        builder.add_32bit_float(val)
+    return builder.to_registers()
+
+
+def bench_encode(args):
+    """ Compare the payload builder encoding with the precompiled struct
+    encoders of YocotpuceBinding, for each supported encoding.
+    """
+    number = 10000 * args.repeat
+    for encoding in sorted(ymodbustcp.ENCODINGS):
+        binding = ymodbustcp.YocotpuceBinding(0, "BENCH.genericSensor1", encoding, backend='sim')
+        registers = [0] * binding.get_reglen()
+        report("payload builder, %s" % encoding,
+               timeit.timeit(lambda: legacy_encode(encoding, 21.5), number=number), number)
+        report("encode_into, %s" % encoding,
+               timeit.timeit(lambda: binding.encode_into(registers, 0, 21.5), number=number), number)
+
+
+# --------------------------------------------------------------------------- #
+# register storage
+# --------------------------------------------------------------------------- #
+
+
+def bench_image(args):
+    """ Compare the list and byte image storages on a full 65536 register
+    map: memory used by the registers, cost of storing a whole acquisition
+    pass and of reading 125 registers, the largest Modbus read.
+    """
+    devices = build_map(32768)
+    end = map_end(devices)
+    measures = [(binding, 20.0 + i % 100) for i, binding in enumerate(devices.values())]
+    addresses = [random.randrange(0, end - 125) for _ in range(1000)]
+    for kind in (ymodbustcp.YoctopuceDataBlock, ymodbustcp.YoctopuceImageBlock):
+        block = kind(devices)
+        tracemalloc.start()
+        block.store_many(measures)
+        if kind is ymodbustcp.YoctopuceImageBlock:
+            size = sys.getsizeof(block.image)
+        else:
+            # the list and the int objects created by the first pass
+            size = sys.getsizeof(block.values) + tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("%-40s %10.1f KiB" % ("%s registers" % kind.__name__, size / 1024.0))
+
+        def read():
+            for address in addresses:
+                block.getValues(address, 125)
+
+        passes = changing_passes(measures)
+        report("%s store pass" % kind.__name__,
+               timeit.timeit(lambda: block.store_many(next(passes)), number=args.repeat),
+               args.repeat)
+        report("%s read 125" % kind.__name__,
+               timeit.timeit(read, number=args.repeat), len(addresses) * args.repeat)
+
+
+def build_spread_map(size, spacing, encoding='float32'):
+    """ Build a device map of size fresh bindings, spacing registers apart
+    """
+    devices = {}
+    for i in range(size):
+        binding = ymodbustcp.YocotpuceBinding(i * spacing, "BENCH%05d.genericSensor1" % i,
+                                              encoding, backend='sim')
+        binding.timestamp = time.monotonic()
+        devices[binding.reg_addr] = binding
+    return devices
+
+
+def bench_sparse(args):
+    """ Compare the dense and sparse list storages on a map of 64 sensors
+    spread over the whole address space: memory used by the registers,
+    cost of storing an acquisition pass, of reading one sensor and of a
+    125 register read crossing gaps.
+    """
+    devices = build_spread_map(64, 1024)
+    bindings = list(devices.values())
+    measures = [(binding, 20.0 + i) for i, binding in enumerate(bindings)]
+    singles = [random.choice(bindings).reg_addr for _ in range(1000)]
+    ranges = [random.randrange(0, map_end(devices) - 125) for _ in range(1000)]
+    for kind in (ymodbustcp.YoctopuceDataBlock, ymodbustcp.YoctopuceSparseBlock):
+        tracemalloc.start()
+        block = kind(devices)
+        block.store_many(measures)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("%-40s %10.1f KiB" % ("%s registers" % kind.__name__, size / 1024.0))
+
+        def read_single():
+            for address in singles:
+                block.getValues(address, 2)
+
+        def read_range():
+            for address in ranges:
+                block.getValues(address, 125)
+
+        passes = changing_passes(measures)
+        report("%s store pass" % kind.__name__,
+               timeit.timeit(lambda: block.store_many(next(passes)), number=args.repeat),
+               args.repeat)
+        report("%s read 2" % kind.__name__,
+               timeit.timeit(read_single, number=args.repeat), len(singles) * args.repeat)
+        report("%s read 125" % kind.__name__,
+               timeit.timeit(read_range, number=args.repeat), len(ranges) * args.repeat)
+
+
+# --------------------------------------------------------------------------- #
+# read through
+# --------------------------------------------------------------------------- #
+
+
+def bench_readthrough(args):
+    """ Compare reading the sensors of a read through request one after
+    the other and with the read pool, for 8 modules of 4 simulated sensors
+    answering in 5 ms each, read all at once.
+    """
+    devices = {}
+    for i in range(32):
+        binding = ymodbustcp.YocotpuceBinding(2 * i, "MODULE%02d.genericSensor%d" % (i // 4, i % 4),
+                                              'float32', backend='sim?latency=0.005')
+        devices[binding.reg_addr] = binding
+    end = map_end(devices)
+    for threads in (0, 2, 4, 8):
+        pool = None
+        if threads:
+            pool = ymodbustcp.ThreadPoolExecutor(max_workers=threads)
+        block = ymodbustcp.YoctopuceDataBlock(devices, read_through=True, read_pool=pool)
+        name = "%d threads" % threads if threads else "sequential"
+        report("read through, %s" % name,
+               timeit.timeit(lambda: block.getValues(0, end), number=args.repeat), args.repeat)
+        if pool is not None:
+            pool.shutdown()
+
+
+# --------------------------------------------------------------------------- #
+# response cache
+# --------------------------------------------------------------------------- #
+
+
+def bench_responses(args):
+    """ Compare executing and encoding a register read request with the
+    pymodbus implementation and from the response cache, for hot reads of
+    one sensor and of 125 registers, then the hit ratio of 5 masters
+    reading the same 100 ranges between two acquisition passes, which
+    change one sensor in ten.
+    """
+    devices = build_map(1000)
+    measures = [(binding, 20.0 + i % 100) for i, binding in enumerate(devices.values())]
+    for kind, name in ((ymodbustcp.ReadHoldingRegistersRequest, 'pymodbus'),
+                       (ymodbustcp.CachedReadHoldingRegistersRequest, 'cached')):
+        block = ymodbustcp.YoctopuceImageBlock(devices)
+        block.store_many(measures)
+        block.responses = ymodbustcp.ResponseCache(block)
+        slave = ymodbustcp.build_slave_context(block)
+        for count in (2, 125):
+            request = kind(0, count)
+            report("%s read %d" % (name, count),
+                   timeit.timeit(lambda: request.execute(slave).encode(), number=1000 * args.repeat),
+                   1000 * args.repeat)
+    block = ymodbustcp.YoctopuceImageBlock(devices)
+    block.responses = ymodbustcp.ResponseCache(block)
+    slave = ymodbustcp.build_slave_context(block)
+    reads = [ymodbustcp.CachedReadHoldingRegistersRequest(20 * i, 20) for i in range(100)]
+    bindings = list(devices.values())
+    for _ in range(args.repeat):
+        block.store_many([(binding, random.uniform(0, 100))
+                          for binding in random.sample(bindings, len(bindings) // 10)])
+        for master in range(5):
+            for request in reads:
+                request.execute(slave)
+    print("%-40s %10.1f %%" % ("hit ratio, 5 masters", 100 * block.responses.hit_ratio()))
+
+
+# --------------------------------------------------------------------------- #
+# fast register reads
+# --------------------------------------------------------------------------- #
+
+
+class NullTransport(object):
+
+    def write(self, data):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+def bench_fastread(args):
+    """ Compare serving a received register read frame with the pymodbus
+    decoder, request execution and framer, and with the FastReadPath,
+    for reads of one sensor and of 125 registers of a byte image block.
+    """
+    from pymodbus.factory import ServerDecoder
+    from pymodbus.framer.socket_framer import ModbusSocketFramer
+
+    block = ymodbustcp.YoctopuceImageBlock(build_map(1000))
+    context = ymodbustcp.ModbusServerContext(slaves=ymodbustcp.build_slave_context(block),
+                                             single=True)
+    framer = ModbusSocketFramer(ServerDecoder())
+    transport = NullTransport()
+    fast = ymodbustcp.FastReadPath(context, transport)
+    number = 1000 * args.repeat
+    for count in (2, 125):
+        frame = struct.pack('>HHHBBHH', 1, 0, 6, 1, 3, 0, count)
+
+        def pymodbus_read():
+            def execute(request):
+                response = request.execute(context[request.unit_id])
+                response.transaction_id = request.transaction_id
+                response.unit_id = request.unit_id
+                transport.write(framer.buildPacket(response))
+            framer.processIncomingPacket(frame, execute, unit=0, single=True)
+
+        report("pymodbus read %d" % count, timeit.timeit(pymodbus_read, number=number), number)
+        report("fast path read %d" % count,
+               timeit.timeit(lambda: fast.feed(frame), number=number), number)
+
+
+# --------------------------------------------------------------------------- #
+# Modbus TCP load generation
+# --------------------------------------------------------------------------- #
+
+# the largest number of registers a single Modbus read may return
+MAX_READ = 125
+
+
+def write_sim_map(path, size, backend):
+    """ Write a device map of size simulated float32 sensors
+
+    :returns: The number of registers of the map
+    """
+    with open(path, 'w') as stream:
+        for i in range(size):
+            stream.write("0x%04x,BENCH%05d.genericSensor1,float32,backend=%s\n"
+                         % (2 * i, i, backend))
+    return 2 * size
+
+
+def read_pattern(pattern, registers):
+    """ Return a generator of the (address, count) reads of a client
+
+    :param pattern: 'single' for one random binding, 'sweep' for the full
+                    map in chunks of MAX_READ, 'random' for random ranges
+    :param registers: The number of registers of the map
+    """
+    address = 0
+    while True:
+        if pattern == 'single':
+            yield 2 * random.randrange(registers // 2), 2
+        elif pattern == 'sweep':
+            count = min(MAX_READ, registers - address)
+            yield address, count
+            address = (address + count) % registers
+        else:
+            count = random.randint(1, min(MAX_READ, registers))
+            yield random.randrange(registers - count + 1), count
+
+
+async def modbus_client(host, port, function, reads, deadline, latencies, errors):
+    """ Issue reads back to back on one connection until deadline, adding
+    the latency of each successful read to latencies.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    tid = 0
+    try:
+        while time.monotonic() < deadline:
+            address, count = next(reads)
+            tid = (tid + 1) & 0xffff
+            request = struct.pack('>HHHBBHH', tid, 0, 6, 0, function, address, count)
+            start = time.perf_counter()
+            writer.write(request)
+            header = await reader.readexactly(7)
+            length = struct.unpack('>HHHB', header)[2]
+            pdu = await reader.readexactly(length - 1)
+            elapsed = time.perf_counter() - start
+            if pdu[0] & 0x80:
+                errors.append(pdu[1])
+            else:
+                latencies.append(elapsed)
+    finally:
+        writer.close()
+
+
+async def drive_load(args, registers):
+    deadline = time.monotonic() + args.duration
+    latencies = []
+    errors = []
+    clients = [modbus_client(args.host, args.port, args.function,
+                             read_pattern(args.pattern, registers),
+                             deadline, latencies, errors)
+               for _ in range(args.clients)]
+    await asyncio.gather(*clients)
+    return latencies, errors
+
+
+def wait_for_port(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start listening on %s:%d" % (host, port))
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_server(args):
+    """ Start the server against a simulated sensor map and load it with
+    concurrent Modbus TCP clients, reporting the throughput and the
+    latency percentiles of the reads.
+    """
+    server = None
+    if args.connect:
+        registers = args.registers
+    else:
+        map_file = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+        map_file.close()
+        registers = write_sim_map(map_file.name, args.bindings, args.backend)
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                'ymodbustcp.py'),
+                   '--map', map_file.name, '--host', args.host, '--port', str(args.port),
+                   '--log-level', 'WARNING'] + shlex.split(args.server_args)
+        server = subprocess.Popen(command)
+    try:
+        wait_for_port(args.host, args.port, 30)
+        latencies, errors = asyncio.run(drive_load(args, registers))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            os.unlink(map_file.name)
+    latencies.sort()
+    print("%d clients, %s reads, %.1f s" % (args.clients, args.pattern, args.duration))
+    print("%-40s %10.0f reads/s" % ("throughput", len(latencies) / args.duration))
+    print("%-40s %10d" % ("exception responses", len(errors)))
+    if latencies:
+        for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+            print("%-40s %10.3f ms" % ("latency " + name, percentile(latencies, fraction) * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ymodbustcp benchmarks")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="number of repetitions of each measure")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    commands.add_parser("lookup", help="register range lookup cost").set_defaults(run=bench_lookup)
+    commands.add_parser("encode", help="register encoding cost").set_defaults(run=bench_encode)
+    commands.add_parser("image", help="list and byte image register storage").set_defaults(run=bench_image)
+    commands.add_parser("sparse", help="dense and sparse register storage").set_defaults(run=bench_sparse)
+    commands.add_parser("readthrough", help="sequential and parallel sensor reads").set_defaults(
+        run=bench_readthrough)
+    commands.add_parser("responses", help="encoded and cached read responses").set_defaults(
+        run=bench_responses)
+    commands.add_parser("fastread", help="pymodbus and fast path register reads").set_defaults(
+        run=bench_fastread)
+    server = commands.add_parser("server", help="Modbus TCP load generation")
+    server.set_defaults(run=bench_server)
+    server.add_argument("--clients", type=int, default=10, help="concurrent connections")
+    server.add_argument("--duration", type=float, default=10, help="seconds of load")
+    server.add_argument("--pattern", choices=("single", "sweep", "random"), default="single",
+                        help="one binding, full map sweeps or random ranges")
+    server.add_argument("--function", type=int, choices=(3, 4), default=3,
+                        help="holding (3) or input (4) register reads")
+    server.add_argument("--bindings", type=int, default=100, help="simulated sensors in the map")
+    server.add_argument("--backend", default="sim", help="backend of the simulated sensors")
+    server.add_argument("--server-args", default="",
+                        help="extra ymodbustcp.py arguments, e.g. '--server asyncio --image'")
+    server.add_argument("--host", default="localhost")
+    server.add_argument("--port", type=int, default=5021)
+    server.add_argument("--connect", action="store_true",
+                        help="load an already running server instead of starting one")
+    server.add_argument("--registers", type=int, default=6,
+                        help="number of registers of the map of an already running server")
+    args = parser.parse_args()
+    ymodbustcp.log.setLevel(logging.WARNING)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
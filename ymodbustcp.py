@@ -10,19 +10,38 @@ a device-mapping.txt file.
 # --------------------------------------------------------------------------- #
 # import the python libraries we need
 # --------------------------------------------------------------------------- #
-from multiprocessing import Queue
+import argparse
+import asyncio
+import bisect
+import heapq
+import math
+import multiprocessing
+import os
+import random
+import struct
+import threading
+import time
+from urllib.parse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 # --------------------------------------------------------------------------- #
 # configure the service logging
 # --------------------------------------------------------------------------- #
 import logging
 
-from pymodbus.constants import Endian
-from pymodbus.payload import BinaryPayloadBuilder
 from pymodbus.server.asynchronous import StartTcpServer
 from pymodbus.device import ModbusDeviceIdentification
-from pymodbus.datastore import ModbusSequentialDataBlock
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSparseDataBlock
+from pymodbus.datastore.store import BaseModbusDataBlock
 from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
+from pymodbus.exceptions import NoSuchSlaveException
+from pymodbus.pdu import ModbusResponse
+from pymodbus.register_read_message import ReadHoldingRegistersRequest, ReadInputRegistersRequest
 from yoctopuce.yocto_api import *
+from yoctopuce.yocto_pwmoutput import YPwmOutput
+from yoctopuce.yocto_relay import YRelay
+from yoctopuce.yocto_servo import YServo
 
 # --------------------------------------------------------------------------- #
 # import the modbus libraries we need
@@ -33,85 +52,2614 @@ log = logging.getLogger()
 log.setLevel(logging.DEBUG)
 
 
+# --------------------------------------------------------------------------- #
+# acquisition defaults, overridable per binding in the device map
+# --------------------------------------------------------------------------- #
+DEFAULT_REFRESH_PERIOD = 0.5
+DEFAULT_MAX_STALENESS = 0
+# unit id of the lines of a multi unit device map without unit option
+DEFAULT_UNIT = 1
+# maximal time to wait for the first acquisition pass before serving
+STARTUP_TIMEOUT = 10
+
+# registers of unmapped gap merged into a segment of a sparse block, and
+# fill ratio of the mapped registers under which a block is made sparse
+SEGMENT_GAP = 16
+SPARSE_FILL_RATIO = 0.5
+
+# cadence learning of the prefetch: relative jitter of the intervals
+# between the reads of a range, intervals matching before a range is
+# prefetched, missed reads after which it is forgotten, margin added to
+# the acquisition time and number of ranges tracked per block
+CADENCE_TOLERANCE = 0.2
+CADENCE_SAMPLES = 3
+CADENCE_MISSES = 2
+PREFETCH_MARGIN = 0.005
+MAX_CADENCE_RANGES = 4096
+
+# register ranges whose encoded response is cached per data block
+RESPONSE_CACHE_SIZE = 1024
+
+# Modbus TCP frames of the fast register reads: MBAP header, then the
+# function code, address and count of a request, or the function code
+# and byte count of a response
+MBAP_HEADER = struct.Struct('>HHHB')
+READ_REQUEST = struct.Struct('>HHHBBHH')
+READ_RESPONSE = struct.Struct('>HHHBBB')
+MAX_READ_COUNT = 0x7d
+
+# struct format and conversion of each supported register encoding. int8
+# keeps the value in the high byte of its register, as the pymodbus
+# payload builder used to.
+ENCODINGS = {
+    'int8': ('bx', int),
+    'int16': ('h', int),
+    'int32': ('i', int),
+    'float16': ('e', float),
+    'float32': ('f', float),
+}
+
+
+# status registers of a binding, after its value: age of the value in ms,
+# sample sequence counter and quality word made of the QUALITY_ flags
+STATUS_LEN = 3
+QUALITY_VALID = 0x0001
+QUALITY_STALE = 0x0002
+QUALITY_READ_ERROR = 0x0004
+QUALITY_ALARM = 0x0008
+
+
+def parse_flag(value):
+    """ Convert an on/off option of the device map to a bool """
+    return str(value).lower() in ('1', 'yes', 'true', 'on')
+
+
+class StaleMeasureError(Exception):
+    """ Raised when a read covers a binding whose cached value is older
+    than its maximal staleness. The server answers with a slave failure.
+    """
+    pass
+
+
+class TornReadError(Exception):
+    """ Raised when a read of shared memory registers is interrupted by
+    writes SEQLOCK_RETRIES times in a row. The server answers with a
+    slave failure.
+    """
+    pass
+
+
+# --------------------------------------------------------------------------- #
+# sensor backends, to run the server without any Yoctopuce module
+# --------------------------------------------------------------------------- #
+
+
+def is_simulated_hub(url):
+    return url.startswith("sim:")
+
+
+def parse_frequency(freq):
+    """ Convert a Yoctopuce report frequency such as 10/s, 30/m or 2/h
+    into a number of reports per second.
+    """
+    count, _, unit = freq.partition('/')
+    return float(count) / {'s': 1.0, 'm': 60.0, 'h': 3600.0}[unit or 's']
+
+
+class SimulatedMeasure(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def get_averageValue(self):
+        return self.value
+
+
+class SimulatedSensor(object):
+    """ A stand-in for YSensor, configured by a query string such as
+    latency=0.01&jitter=0.005&failure=0.1&waveform=square&min=0&max=100.
+
+    latency and jitter (seconds) delay each read, failure is the
+    probability that a read fails, offline=1 makes every read fail, and
+    the values follow a sine, triangle, square, ramp, random or constant
+    waveform between min and max with the given period (seconds).
+    Callbacks are invoked by handle_events(), called by the event pump.
+    """
+
+    WAVEFORMS = {
+        'sine': lambda phase: 0.5 + 0.5 * math.sin(2 * math.pi * phase),
+        'triangle': lambda phase: 1.0 - abs(2.0 * phase - 1.0),
+        'square': lambda phase: 1.0 if phase < 0.5 else 0.0,
+        'ramp': lambda phase: phase,
+        'random': lambda phase: random.random(),
+        'constant': lambda phase: 0.5,
+    }
+
+    def __init__(self, hwid, params=''):
+        params = dict(parse_qsl(params))
+        self.hwid = hwid
+        self.latency = float(params.get('latency', 0))
+        self.jitter = float(params.get('jitter', 0))
+        self.failure = float(params.get('failure', 0))
+        self.offline = parse_flag(params.get('offline', '0'))
+        self.waveform = self.WAVEFORMS[params.get('waveform', 'sine')]
+        self.minimum = float(params.get('min', 15))
+        self.maximum = float(params.get('max', 25))
+        self.period = float(params.get('period', 60))
+        # spread the phases so that the sensors do not all move together
+        self._offset = (hash(hwid) % 1000) / 1000.0
+        self._value_callback = None
+        self._report_callback = None
+        self._report_interval = 1.0
+        self._last_value = None
+        self._next_report = 0
+
+    def get_currentValue(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.offline or random.random() < self.failure:
+            return YSensor.CURRENTVALUE_INVALID
+        return self._sample()
+
+    def _sample(self):
+        phase = (time.time() / self.period + self._offset) % 1.0
+        return self.minimum + (self.maximum - self.minimum) * self.waveform(phase)
+
+    def get_hardwareId(self):
+        return self.hwid
+
+    def set_reportFrequency(self, freq):
+        self._report_interval = 1.0 / parse_frequency(freq)
+
+    def registerValueCallback(self, callback):
+        self._value_callback = callback
+        self._last_value = None
+
+    def registerTimedReportCallback(self, callback):
+        self._report_callback = callback
+
+    def handle_events(self, now):
+        """ Invoke the registered callbacks, like YAPI.HandleEvents does
+        for real sensors.
+        """
+        if self.offline:
+            return
+        if self._value_callback is not None:
+            value = "%.3f" % self._sample()
+            if value != self._last_value:
+                self._last_value = value
+                self._value_callback(self, value)
+        if self._report_callback is not None and now >= self._next_report:
+            self._next_report = now + self._report_interval
+            self._report_callback(self, SimulatedMeasure(self._sample()))
+
+
+def find_yoctopuce_sensor(hwid, params=''):
+    return YSensor.FindSensor(hwid)
+
+
+# factories of the sensor objects, indexed by backend name
+SENSOR_BACKENDS = {
+    'yoctopuce': find_yoctopuce_sensor,
+    'sim': SimulatedSensor,
+}
+
+
+def open_sensor(hwid, backend):
+    """ Create the sensor object of a binding
+
+    :param hwid: The hardware id or logical name of the sensor
+    :param backend: A backend name optionally followed by ?parameters,
+                    e.g. 'yoctopuce' or 'sim?latency=0.01'. A simulated
+                    hub url like sim://name?latency=0.01 is accepted too.
+    :returns: An object with the YSensor interface used by the bindings
+    """
+    name, params = split_backend(backend)
+    if name not in SENSOR_BACKENDS:
+        raise ValueError("unknown sensor backend %s for %s" % (name, hwid))
+    return SENSOR_BACKENDS[name](hwid, params)
+
+
+def split_backend(backend):
+    """ Split a backend spec into its name and its parameters
+    """
+    name, _, params = backend.partition('?')
+    return name.split(':')[0], params
+
+
+class SingleFlight(object):
+    """ Coalesce concurrent calls: while a call is in flight, the other
+    callers wait for it and share its result (or exception) instead of
+    starting their own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flight = None
+        self.shared = 0
+
+    def do(self, function, *args):
+        with self._lock:
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = [threading.Event(), None, None]
+            else:
+                self.shared += 1
+        done = flight[0]
+        if not leader:
+            done.wait()
+        else:
+            try:
+                flight[1] = function(*args)
+            except Exception as ex:
+                flight[2] = ex
+            finally:
+                with self._lock:
+                    self._flight = None
+                done.set()
+        if flight[2] is not None:
+            raise flight[2]
+        return flight[1]
+
+
 class YocotpuceBinding(object):
 
-    def __init__(self, reg_no, hwid, encoding):
-        self.reg_addr = reg_no
-        self.hwid = hwid
-        self.ysensor = YSensor.FindSensor(hwid)
-        self.encoding = encoding
-        self.reg_len = 2
-        if self.encoding == 'int8':
-            self.reg_len = 1
-        elif self.encoding == 'int32' or self.encoding == 'float32':
-            self.reg_len = 2
+    def __init__(self, reg_no, hwid, encoding, refresh=DEFAULT_REFRESH_PERIOD,
+                 stale=DEFAULT_MAX_STALENESS, report=None, byteorder='big',
+                 wordorder='big', hub='usb', backend=None, low=None, high=None,
+                 status=False, deadband=0):
+        self.reg_addr = reg_no
+        self.hwid = hwid
+        self.hub = hub
+        if backend is None:
+            backend = hub if is_simulated_hub(hub) else 'yoctopuce'
+        self.backend = backend
+        self.ysensor = open_sensor(hwid, backend)
+        self.encoding = encoding
+        self.byteorder = byteorder
+        self.wordorder = wordorder
+        self._compile_encoder()
+        # background acquisition settings (seconds, 0 means no limit)
+        self.refresh_period = float(refresh)
+        self.max_staleness = float(stale)
+        if self.refresh_period <= 0:
+            raise ValueError("refresh period of %s must be positive" % hwid)
+        # change of value deadband, relative to the stored value when
+        # given in percent (e.g. deadband=0.5%), see accept()
+        deadband = str(deadband)
+        self.deadband_relative = deadband.endswith('%')
+        self.deadband = float(deadband.rstrip('%'))
+        if self.deadband < 0:
+            raise ValueError("deadband of %s must not be negative" % hwid)
+        self._stored_block = None
+        self.value = None
+        self.timestamp = None
+        # read demand, see PollSchedule: the last time a request read the
+        # binding, whether it is polled as idle, and how to wake its poller
+        self.last_read = None
+        self.idle = False
+        self.on_wake = None
+        # status registers following the value, see status_words()
+        self.status = parse_flag(status)
+        self.sequence = 0
+        self.read_failed = False
+        # event driven acquisition settings, see start_events()
+        self.report_frequency = report
+        self.push_on_change = False
+        self.serial = None
+        # alarm thresholds, see YoctopuceAlarmBlock
+        self.low = None if low is None else float(low)
+        self.high = None if high is None else float(high)
+        # concurrent requests share a single hardware read
+        self._single_flight = SingleFlight()
+
+    def _compile_encoder(self):
+        """ Resolve the encoding once into precompiled structs. pack_value
+        returns the value as it is sent on the wire, i.e. registers in
+        big endian, and _words splits it into register words.
+        """
+        if self.encoding not in ENCODINGS:
+            raise ValueError("unsupported encoding %s for %s" % (self.encoding, self.hwid))
+        for order in (self.byteorder, self.wordorder):
+            if order not in ('big', 'little'):
+                raise ValueError("unsupported byte or word order %s for %s" % (order, self.hwid))
+        code, convert = ENCODINGS[self.encoding]
+        value_struct = struct.Struct(('>' if self.byteorder == 'big' else '<') + code)
+        self.reg_len = (value_struct.size + 1) // 2
+        self._words = struct.Struct('>%dH' % self.reg_len)
+        pack = value_struct.pack
+        if self.reg_len > 1 and self.wordorder != self.byteorder:
+            # mixed orders: the value packed in byte order, words swapped
+            def pack_value(val):
+                raw = pack(convert(val))
+                return raw[2:] + raw[:2]
+        else:
+            def pack_value(val):
+                return pack(convert(val))
+        self.pack_value = pack_value
+        # how the value appears in a struct packing a whole register image
+        if self.byteorder == 'big' and (self.reg_len == 1 or self.wordorder == 'big'):
+            self.struct_code = code
+            self.image_arg = convert
+        else:
+            self.struct_code = '%ds' % (2 * self.reg_len)
+            self.image_arg = pack_value
+
+    def encode_value(self, val):
+        return list(self._words.unpack(self.pack_value(val)))
+
+    def can_encode(self, val):
+        """ Tell if a value fits the encoding of the binding, flagging it
+        as a failed read otherwise, e.g. 40000 for an int16
+
+        :param val: The measured value
+        :returns: True if the value can be stored in the registers
+        """
+        try:
+            self.pack_value(val)
+        except (struct.error, OverflowError, ValueError) as ex:
+            self.read_failed = True
+            log.error("unable to encode %r for %s: %s" % (val, self.hwid, ex))
+            return False
+        return True
+
+    def encode_into(self, org_val, offset, val):
+        """ Write the encoded value into a register list
+
+        :param org_val: The register list to update
+        :param offset: The index of the first register of the binding
+        :param val: The value to encode
+        """
+        org_val[offset:offset + self.reg_len] = self._words.unpack(self.pack_value(val))
+
+    def overlaps(self, address, count):
+        if address + count <= self.reg_addr:
+            return False
+        return address < self.reg_addr + self.get_reglen()
+
+    def read_value(self):
+        """ Read the sensor
+
+        :returns: The measured value, or None if the sensor is unreachable
+        """
+        try:
+            val = self.ysensor.get_currentValue()
+        except Exception:
+            self.read_failed = True
+            raise
+        self.read_failed = val == YSensor.CURRENTVALUE_INVALID
+        if self.read_failed:
+            log.warning("%s is not reachable" % self.hwid)
+            return None
+        return val
+
+    def update_measure(self, block):
+        """ Read the sensor and store the encoded value in the registers.
+        Callers arriving while a read is in progress wait for it and get
+        its result rather than issuing their own USB request.
+
+        :param block: The YoctopuceDataBlock holding the registers
+        :returns: The measured value, or None if the sensor is unreachable
+        """
+        return self._single_flight.do(self._update_measure, block)
+
+    def _update_measure(self, block):
+        # get sensor values
+        val = self.read_value()
+        if val is None:
+            return None
+        return self.store_measure(block, val)
+
+    def store_measure(self, block, val):
+        """ Store an already acquired value in the registers
+
+        :param block: The YoctopuceDataBlock holding the registers
+        :param val: The measured value
+        :returns: The stored value
+        """
+        if not self.accept(block, val):
+            block.touch(self)
+            return val
+        if not self.can_encode(val):
+            return None
+        # remember first, a concurrent repack of the whole image
+        # must not write back the previous value
+        self.remember(val)
+        block.store(self, val)
+        return val
+
+    def accept(self, block, val):
+        """ Account a new sample and tell if it must be stored in the
+        registers of a block: the first sample the block gets from the
+        binding, or a value out of the deadband of the stored one. The
+        other samples only refresh the age and sequence number of the
+        stored value.
+
+        :param block: The data block holding the registers
+        :param val: The measured value
+        :returns: True if the value must be encoded into the registers
+        """
+        if block is self._stored_block and self.value is not None:
+            band = self.deadband
+            if self.deadband_relative:
+                band = band * abs(self.value) / 100
+            if abs(val - self.value) <= band:
+                self.touch()
+                return False
+        self._stored_block = block
+        return True
+
+    def wake(self):
+        """ Tell the poller of an idle binding that it is read again
+        """
+        on_wake = self.on_wake
+        if on_wake is not None:
+            on_wake(self)
+
+    def remember(self, val):
+        self.value = val
+        self.touch()
+
+    def touch(self):
+        self.timestamp = time.monotonic()
+        self.sequence = (self.sequence + 1) & 0xffff
+
+    def status_words(self, now):
+        """ Return the status registers of the binding: the age of the
+        value in ms (saturated to 0xffff, also meaning never acquired),
+        the sequence number of the value, incremented by each new sample,
+        and the quality word.
+        """
+        if self.timestamp is None:
+            return [0xffff, self.sequence, QUALITY_READ_ERROR if self.read_failed else 0]
+        quality = QUALITY_VALID
+        if self.is_stale(now):
+            quality |= QUALITY_STALE
+        if self.read_failed:
+            quality |= QUALITY_READ_ERROR
+        if self.in_alarm():
+            quality |= QUALITY_ALARM
+        return [min(int((now - self.timestamp) * 1000), 0xffff), self.sequence, quality]
+
+    def start_events(self, block):
+        """ Let the sensor push its values into the data block instead of
+        being polled: a timed report callback when a report frequency
+        is configured (e.g. report=10/s), a value change callback otherwise.
+        Callbacks are invoked from the thread calling YAPI.HandleEvents.
+
+        :param block: The YoctopuceDataBlock receiving the values
+        """
+        if self.report_frequency:
+            self.ysensor.set_reportFrequency(self.report_frequency)
+            self.ysensor.registerTimedReportCallback(
+                lambda fct, measure: self._on_event(block, measure.get_averageValue()))
+        else:
+            # the device only advertises changes, so a steady value
+            # is still a fresh value as long as the module is plugged
+            self.push_on_change = True
+            self.ysensor.registerValueCallback(
+                lambda fct, value: self._on_event(block, value))
+
+    def stop_events(self):
+        if self.report_frequency:
+            self.ysensor.registerTimedReportCallback(None)
+        else:
+            self.ysensor.registerValueCallback(None)
+        self.push_on_change = False
+
+    def _on_event(self, block, value):
+        try:
+            val = float(value)
+        except ValueError:
+            log.warning("%s sent an invalid value: %r" % (self.hwid, value))
+            return
+        block.publish(self, val)
+
+    def get_serial(self):
+        """ Return the serial number of the module hosting the sensor,
+        or None while it has never been seen online.
+        """
+        if self.serial is None:
+            hwid = self.ysensor.get_hardwareId()
+            if hwid != YSensor.HARDWAREID_INVALID:
+                self.serial = hwid.split('.')[0]
+        return self.serial
+
+    def get_module(self):
+        """ Return the serial number of the module hosting the sensor, or
+        the module part of the hardware id while it has never been seen
+        """
+        serial = self.get_serial()
+        return serial if serial is not None else self.hwid.split('.')[0]
+
+    def is_stale(self, now):
+        if self.timestamp is None:
+            return True
+        if self.max_staleness <= 0 or self.push_on_change:
+            return False
+        return now - self.timestamp > self.max_staleness
+
+    def in_alarm(self):
+        """ Tell if the last value is outside the [low, high] range
+        """
+        if self.value is None:
+            return False
+        if self.low is not None and self.value < self.low:
+            return True
+        return self.high is not None and self.value > self.high
+
+    def get_hwid(self):
+        return self.hwid
+
+    def get_reglen(self):
+        """ Return the number of registers of the binding, status included
+        """
+        if self.status:
+            return self.reg_len + STATUS_LEN
+        return self.reg_len
+
+
+# --------------------------------------------------------------------------- #
+# actuators, driven by writes to holding registers
+# --------------------------------------------------------------------------- #
+
+
+class SimulatedActuator(object):
+    """ A stand-in for the actuator functions, recording the last written
+    register value after the configured latency (see SimulatedSensor).
+    """
+
+    def __init__(self, hwid, params=''):
+        params = dict(parse_qsl(params))
+        self.hwid = hwid
+        self.latency = float(params.get('latency', 0))
+        self.value = 0
+
+    def write(self, value):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.value = value
+
+    def read(self):
+        return self.value
+
+
+def to_signed16(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+# for each actuator kind: the function finder, and how a register value
+# is written to and read back from the function
+ACTUATORS = {
+    'relay': (YRelay.FindRelay,
+              lambda fct, value: fct.set_state(YRelay.STATE_B if value else YRelay.STATE_A),
+              lambda fct: {YRelay.STATE_A: 0, YRelay.STATE_B: 1}.get(fct.get_state())),
+    'pwm': (YPwmOutput.FindPwmOutput,
+            lambda fct, value: fct.set_dutyCycle(value / 100.0),
+            lambda fct: (None if fct.get_dutyCycle() == YPwmOutput.DUTYCYCLE_INVALID
+                         else int(round(fct.get_dutyCycle() * 100)))),
+    'servo': (YServo.FindServo,
+              lambda fct, value: fct.set_position(to_signed16(value)),
+              lambda fct: (None if fct.get_position() == YServo.POSITION_INVALID
+                           else fct.get_position() & 0xffff)),
+}
+
+
+class YoctopuceActuator(object):
+    """ A holding register driving a Yoctopuce function: a relay (0 for
+    state A, 1 for state B), a PWM output (duty cycle in 1/100 %) or a
+    servo (signed position, -1000 to 1000).
+    """
+
+    def __init__(self, reg_no, hwid, kind, hub='usb', backend=None):
+        if kind not in ACTUATORS:
+            raise ValueError("unsupported actuator %s for %s" % (kind, hwid))
+        self.reg_addr = reg_no
+        self.reg_len = 1
+        self.hwid = hwid
+        self.kind = kind
+        self.hub = hub
+        if backend is None:
+            backend = hub if is_simulated_hub(hub) else 'yoctopuce'
+        self.backend = backend
+        name, params = split_backend(backend)
+        if name == 'sim':
+            fct = SimulatedActuator(hwid, params)
+            self._write = fct.write
+            self._read = fct.read
+        elif name == 'yoctopuce':
+            find, write, read = ACTUATORS[kind]
+            fct = find(hwid)
+            self._write = lambda value: write(fct, value)
+            self._read = lambda: read(fct)
+        else:
+            raise ValueError("unknown actuator backend %s for %s" % (name, hwid))
+        # last written value, served when the register is read
+        self.value = 0
+
+    def get_module(self):
+        return self.hwid.split('.')[0]
+
+    def read_state(self):
+        """ Read the current state of the function (USB I/O)
+
+        :returns: The register value of the state, or None if unknown
+        """
+        return self._read()
+
+    def apply(self, value):
+        """ Write a register value to the function (USB I/O)
+        """
+        self._write(value)
+
+
+# --------------------------------------------------------------------------- #
+# create your custom data block with callbacks
+# --------------------------------------------------------------------------- #
+
+
+class YoctopuceDataBlock(ModbusSequentialDataBlock):
+    """ A datablock that stores the new value in memory
+    and performs a custom action after it has been stored.
+    """
+
+    def __init__(self, devices, read_through=False, read_pool=None):
+        self.devices = devices
+        self.read_through = read_through
+        # executor reading the sensors of different modules concurrently
+        # in read through mode, None to read them one after the other
+        self.read_pool = read_pool
+        # ReadCadence learning the polling periods of the clients
+        self.cadence = None
+        # incremented by each change of the registers, None if they are
+        # written by other processes
+        self.generation = 0
+        start = 0xffff if devices else 0
+        end = 0
+        for reg in devices.keys():
+            reglen = devices[reg].get_reglen()
+            if reg < start:
+                start = reg
+            if reg + reglen > end:
+                end = reg + reglen
+        self._allocate(start, end - start)
+        self._build_index()
+
+    def _allocate(self, start, length):
+        # as ModbusSequentialDataBlock.__init__, which needs a register to
+        # tell the default value, while a unit of actuators has none
+        self.address = start
+        self.values = [0] * length
+        self.default_value = 0
+        self.length = length
+
+    def _build_index(self):
+        """ Sort the bindings by register address so that a read only
+        visits the bindings overlapping the requested range. _ends keeps
+        the running maximum of binding ends, which stays sorted even if
+        the device map declares overlapping bindings.
+        """
+        self._bindings = [self.devices[reg] for reg in sorted(self.devices.keys())]
+        self._starts = [binding.reg_addr for binding in self._bindings]
+        self._ends = []
+        end = 0
+        # without overlapping bindings, every binding between the bisected
+        # bounds overlaps the requested range
+        self._disjoint = True
+        for binding in self._bindings:
+            if binding.reg_addr < end:
+                self._disjoint = False
+            end = max(end, binding.reg_addr + binding.get_reglen())
+            self._ends.append(end)
+        self._has_status = any(binding.status for binding in self._bindings)
+
+    def close(self):
+        """ Release the resources of a block which is no longer served
+        """
+
+    def overlapping(self, address, count=1):
+        """ Return the bindings overlapping [address, address + count)
+
+        :param address: The starting address
+        :param count: The number of registers
+        :returns: The list of overlapping bindings, sorted by address
+        """
+        first = bisect.bisect_right(self._ends, address)
+        last = bisect.bisect_left(self._starts, address + count)
+        if self._disjoint:
+            return self._bindings[first:last]
+        return [binding for binding in self._bindings[first:last]
+                if binding.overlaps(address, count)]
+
+    def refresh(self, binding):
+        """ Acquire a new value for one binding and store its registers
+
+        :param binding: The YocotpuceBinding to refresh
+        :returns: The measured value, or None on failure
+        """
+        return binding.update_measure(self)
+
+    def refresh_parallel(self, bindings):
+        """ Refresh bindings with the read pool, the bindings of each module
+        one after the other and the modules concurrently, so that the
+        latency is the one of the slowest module rather than their sum
+
+        :param bindings: The YocotpuceBinding objects to refresh
+        """
+        modules = {}
+        for binding in bindings:
+            modules.setdefault(binding.get_module(), []).append(binding)
+        if len(modules) < 2:
+            for binding in bindings:
+                self.refresh(binding)
+            return
+        futures = [self.read_pool.submit(self._refresh_all, group) for group in modules.values()]
+        for future in futures:
+            future.result()
+
+    def _refresh_all(self, bindings):
+        for binding in bindings:
+            self.refresh(binding)
+
+    def publish(self, binding, val):
+        """ Store a value pushed by a sensor callback
+
+        :param binding: The YocotpuceBinding that produced the value
+        :param val: The measured value
+        """
+        return binding.store_measure(self, val)
+
+    def store(self, binding, val):
+        """ Encode a value into the registers of a binding
+
+        :param binding: The YocotpuceBinding owning the registers
+        :param val: The value to encode
+        """
+        binding.encode_into(self.values, binding.reg_addr - self.address, val)
+        self.generation += 1
+
+    def store_many(self, measures):
+        """ Store the values acquired during one acquisition pass
+
+        :param measures: A list of (binding, value) pairs
+        """
+        for binding, val in measures:
+            binding.store_measure(self, val)
+
+    def touch(self, binding):
+        """ Account a sample of a binding that left its registers unchanged
+
+        :param binding: The YocotpuceBinding owning the registers
+        """
+        pass
+
+    def setValues(self, address, values):
+        super(YoctopuceDataBlock, self).setValues(address, values)
+        self.generation += 1
+
+    def prepare(self, address, count=1):
+        """ Make sure the registers of a range can be served, reading the
+        sensors in read through mode and checking their age otherwise.
+
+        :param address: The starting address
+        :param count: The number of registers
+        """
+        if self.read_through:
+            bindings = self.overlapping(address, count)
+            if self.read_pool is None or len(bindings) < 2:
+                for binding in bindings:
+                    self.refresh(binding)
+            else:
+                self.refresh_parallel(bindings)
+            return
+        now = time.monotonic()
+        bindings = self.overlapping(address, count)
+        if self.cadence is not None:
+            self.cadence.observe(address, count, now, bindings)
+        for binding in bindings:
+            binding.last_read = now
+            if binding.idle:
+                binding.wake()
+            if binding.is_stale(now) and not binding.status:
+                # bindings with status registers report it in their quality
+                raise StaleMeasureError("%s has no recent value" % binding.get_hwid())
+
+    def add_status(self, address, values):
+        """ Fill in the status registers of the bindings overlapping the
+        registers read from address
+
+        :param address: The starting address
+        :param values: The registers read, updated in place
+        :returns: The registers
+        """
+        if not self._has_status:
+            return values
+        now = time.monotonic()
+        end = address + len(values)
+        for binding in self.overlapping(address, len(values)):
+            if binding.status:
+                reg = binding.reg_addr + binding.reg_len
+                for word in binding.status_words(now):
+                    if address <= reg < end:
+                        values[reg - address] = word
+                    reg += 1
+        return values
+
+    def getValues(self, address, count=1):
+        self.prepare(address, count)
+        values = super(YoctopuceDataBlock, self).getValues(address, count)
+        return self.add_status(address, values)
+
+
+class YoctopuceImageBlock(YoctopuceDataBlock):
+    """ A data block storing its registers as a contiguous big endian
+    bytearray, the way they are sent on the wire, instead of a list of
+    Python ints. Reads are sliced out in one struct call and a whole
+    acquisition pass is packed in one struct.pack_into call.
+    """
+
+    def _allocate(self, start, length):
+        self.address = start
+        self.default_value = 0
+        self.length = length
+        self.image = bytearray(2 * length)
+        self._view = memoryview(self.image)
+        # serializes the writers, e.g. the pollers of several hubs
+        self._lock = threading.Lock()
+
+    def _build_index(self):
+        super(YoctopuceImageBlock, self)._build_index()
+        # one struct covering every binding and the gaps between them,
+        # unless the device map declares overlapping bindings
+        fmt = ['>']
+        offset = self.address
+        for binding in self._bindings:
+            if binding.reg_addr < offset:
+                self._image_struct = None
+                return
+            if binding.reg_addr > offset:
+                fmt.append('%dx' % (2 * (binding.reg_addr - offset)))
+            fmt.append(binding.struct_code)
+            offset = binding.reg_addr + binding.reg_len
+            if binding.status:
+                # computed on read, left blank in the image
+                fmt.append('%dx' % (2 * STATUS_LEN))
+                offset += STATUS_LEN
+        self._image_struct = struct.Struct(''.join(fmt))
+
+    def validate(self, address, count=1):
+        return self.address <= address and address + count <= self.address + self.length
+
+    def store(self, binding, val):
+        offset = 2 * (binding.reg_addr - self.address)
+        raw = binding.pack_value(val)
+        with self._lock:
+            self.image[offset:offset + len(raw)] = raw
+            self.generation += 1
+
+    def store_many(self, measures):
+        # repacking the whole image only pays off for large passes
+        if self._image_struct is None or 2 * len(measures) < len(self._bindings):
+            return super(YoctopuceImageBlock, self).store_many(measures)
+        with self._lock:
+            measures = [(binding, val) for binding, val in measures
+                        if binding.accept(self, val) and binding.can_encode(val)]
+            if not measures:
+                return
+            for binding, val in measures:
+                binding.remember(val)
+            args = [binding.image_arg(0 if binding.value is None else binding.value)
+                    for binding in self._bindings]
+            # packed aside, a failure must not leave the image zeroed
+            image = self._image_struct.pack(*args)
+            self._view[:len(image)] = image
+            self.generation += 1
+
+    def getValues(self, address, count=1):
+        self.prepare(address, count)
+        offset = 2 * (address - self.address)
+        return self.add_status(address, list(struct.unpack_from('>%dH' % count, self.image, offset)))
+
+    def read_image(self, address, count=1):
+        """ Return the registers of a range as sent on the wire, for the
+        FastReadPath
+
+        :param address: The starting address
+        :param count: The number of registers
+        :returns: A memoryview of the image, or None if the registers
+                  must be read with getValues
+        """
+        if self._has_status and any(binding.status for binding in self.overlapping(address, count)):
+            return None
+        self.prepare(address, count)
+        offset = 2 * (address - self.address)
+        return self._view[offset:offset + 2 * count]
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        offset = 2 * (address - self.address)
+        struct.pack_into('>%dH' % len(values), self.image, offset, *values)
+        self.generation += 1
+
+
+class RegisterSnapshot(object):
+    """ The registers of a data block after an acquisition pass, never
+    modified once published
+    """
+    __slots__ = ('generation', 'timestamp', 'image')
+
+    def __init__(self, generation, timestamp, image):
+        self.generation = generation
+        self.timestamp = timestamp
+        self.image = image
+
+
+class YoctopuceSnapshotBlock(YoctopuceImageBlock):
+    """ A byte image block whose registers are never written in place:
+    each store publishes a new RegisterSnapshot, numbered by a generation
+    counter. A read takes the current snapshot once, so it needs no lock
+    and never mixes the values of two acquisition passes. Writers are
+    serialized and copy the image, which is cheap once per pass but not
+    meant for per value updates of large maps.
+    """
+
+    def _allocate(self, start, length):
+        self.address = start
+        self.default_value = 0
+        self.length = length
+        self.snapshot = RegisterSnapshot(0, None, bytes(2 * length))
+        self._lock = threading.Lock()
+
+    def _publish(self, image):
+        self.generation += 1
+        self.snapshot = RegisterSnapshot(self.generation, time.monotonic(), bytes(image))
+
+    def _store_values(self, measures):
+        image = bytearray(self.snapshot.image)
+        for binding, val in measures:
+            offset = 2 * (binding.reg_addr - self.address)
+            raw = binding.pack_value(val)
+            image[offset:offset + len(raw)] = raw
+        self._publish(image)
+
+    def store(self, binding, val):
+        with self._lock:
+            self._store_values([(binding, val)])
+
+    def store_many(self, measures):
+        with self._lock:
+            # unchanged values publish no snapshot
+            measures = [(binding, val) for binding, val in measures
+                        if binding.accept(self, val) and binding.can_encode(val)]
+            if not measures:
+                return
+            for binding, val in measures:
+                binding.remember(val)
+            if self._image_struct is None or 2 * len(measures) < len(self._bindings):
+                self._store_values(measures)
+            else:
+                # a large pass packs a new image from every binding value
+                args = [binding.image_arg(0 if binding.value is None else binding.value)
+                        for binding in self._bindings]
+                self._publish(self._image_struct.pack(*args))
+
+    def getValues(self, address, count=1):
+        self.prepare(address, count)
+        snapshot = self.snapshot
+        offset = 2 * (address - self.address)
+        return self.add_status(address,
+                               list(struct.unpack_from('>%dH' % count, snapshot.image, offset)))
+
+    def read_image(self, address, count=1):
+        if self._has_status and any(binding.status for binding in self.overlapping(address, count)):
+            return None
+        self.prepare(address, count)
+        offset = 2 * (address - self.address)
+        return memoryview(self.snapshot.image)[offset:offset + 2 * count]
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        with self._lock:
+            image = bytearray(self.snapshot.image)
+            struct.pack_into('>%dH' % len(values), image, 2 * (address - self.address), *values)
+            self._publish(image)
+
+
+# state record of a binding in shared memory: a sequence lock, odd while
+# the binding is written, followed by the flags, timestamp and value
+RECORD_SEQ = struct.Struct('=I')
+RECORD_STATE = struct.Struct('=Idd')
+RECORD_SIZE = RECORD_SEQ.size + RECORD_STATE.size
+STATE_ACQUIRED = 0x1
+STATE_READ_FAILED = 0x2
+# reads retried while the records they cover are being written, after
+# which the writer is assumed dead in the middle of a write
+SEQLOCK_RETRIES = 10000
+
+
+class SharedRegisters(object):
+    """ A big endian register image followed by the state records of its
+    bindings, in a multiprocessing shared memory segment written by the
+    acquisition processes and read by the Modbus server. Each binding is
+    written by a single process, under the sequence lock of its record.
+    """
+
+    def __init__(self, shm, length, count):
+        self.shm = shm
+        self.length = length
+        self.count = count
+        # the image starts the segment
+        self.buf = shm.buf
+        self._records = (2 * length + 7) & ~7
+        # structs reading consecutive records, by number of records
+        self._formats = {}
+        # sequence locks of the states last copied to the bindings
+        self._loaded = [None] * count
+
+    @classmethod
+    def create(cls, length, count):
+        size = ((2 * length + 7) & ~7) + RECORD_SIZE * count
+        return cls(shared_memory.SharedMemory(create=True, size=max(size, 1)), length, count)
+
+    @classmethod
+    def attach(cls, name, length, count):
+        # spawned processes share the resource tracker of the server,
+        # which unlinks the segment when the server dies
+        return cls(shared_memory.SharedMemory(name=name), length, count)
+
+    def write(self, slot, offset, raw, binding):
+        """ Write the registers and the state of a binding
+
+        :param slot: The index of the record of the binding
+        :param offset: The byte offset of its registers in the image
+        :param raw: Its encoded value, None to only update its state
+        :param binding: The YocotpuceBinding
+        """
+        pos = self._records + slot * RECORD_SIZE
+        seq = RECORD_SEQ.unpack_from(self.buf, pos)[0]
+        RECORD_SEQ.pack_into(self.buf, pos, (seq + 1) & 0xffffffff)
+        if raw is not None:
+            self.buf[offset:offset + len(raw)] = raw
+        flags = STATE_READ_FAILED if binding.read_failed else 0
+        if binding.timestamp is None:
+            RECORD_STATE.pack_into(self.buf, pos + RECORD_SEQ.size, flags, 0.0, 0.0)
+        else:
+            RECORD_STATE.pack_into(self.buf, pos + RECORD_SEQ.size, flags | STATE_ACQUIRED,
+                                   binding.timestamp, binding.value)
+        RECORD_SEQ.pack_into(self.buf, pos, (seq + 2) & 0xffffffff)
+
+    def _records_struct(self, count):
+        records = self._formats.get(count)
+        if records is None:
+            records = self._formats[count] = struct.Struct('=' + 'IIdd' * count)
+        return records
+
+    def sequences(self, slot, count):
+        """ Return the sequence locks of count consecutive records
+        """
+        records = self._records_struct(count).unpack_from(self.buf,
+                                                          self._records + slot * RECORD_SIZE)
+        return records[0::4]
+
+    def load(self, slot, bindings):
+        """ Copy the states of bindings from their consecutive records
+
+        :param slot: The index of the record of the first binding
+        :param bindings: The bindings of the records
+        :returns: The sequence locks the states were read under, or None
+                  if a binding was being written
+        """
+        records = self._records_struct(len(bindings)).unpack_from(
+            self.buf, self._records + slot * RECORD_SIZE)
+        sequences = records[0::4]
+        for seq in sequences:
+            if seq & 1:
+                return None
+        end = slot + len(bindings)
+        if self._loaded[slot:end] == list(sequences):
+            # nothing written since the last load
+            return sequences
+        self._loaded[slot:end] = sequences
+        for i, binding in enumerate(bindings):
+            seq, flags, timestamp, value = records[4 * i:4 * i + 4]
+            binding.read_failed = bool(flags & STATE_READ_FAILED)
+            if flags & STATE_ACQUIRED:
+                binding.timestamp = timestamp
+                binding.value = value
+                binding.sequence = (seq // 2) & 0xffff
+        return sequences
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+
+class YoctopuceSharedBlock(YoctopuceImageBlock):
+    """ A byte image block whose registers and binding states live in
+    SharedRegisters, filled by acquisition processes (see
+    YoctopuceProcess). Reads copy the state of the overlapping bindings,
+    so that staleness, alarms and status registers work as usual, and are
+    retried if a binding is written meanwhile.
+    """
+
+    def _allocate(self, start, length):
+        self.address = start
+        self.default_value = 0
+        self.length = length
+        self._lock = threading.Lock()
+        # the acquisition processes change the registers, see generation
+        self.generation = None
+
+    def _build_index(self):
+        super(YoctopuceSharedBlock, self)._build_index()
+        self._slots = dict((binding.reg_addr, slot) for slot, binding in enumerate(self._bindings))
+        self.shared = SharedRegisters.create(self.length, len(self._bindings))
+        self.image = self.shared.buf
+
+    def slot(self, binding):
+        return self._slots[binding.reg_addr]
+
+    def store(self, binding, val):
+        offset = 2 * (binding.reg_addr - self.address)
+        with self._lock:
+            self.shared.write(self.slot(binding), offset, binding.pack_value(val), binding)
+
+    def store_many(self, measures):
+        for binding, val in measures:
+            binding.store_measure(self, val)
+
+    def touch(self, binding):
+        # the age of the value is read from the record
+        with self._lock:
+            self.shared.write(self.slot(binding), 0, None, binding)
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        with self._lock:
+            struct.pack_into('>%dH' % len(values), self.image, 2 * (address - self.address),
+                             *values)
+
+    def _records(self, address, count):
+        """ Return the first slot and the bindings of the consecutive
+        records covering the bindings overlapping a range
+        """
+        bindings = self.overlapping(address, count)
+        if not bindings:
+            return 0, []
+        first = self.slot(bindings[0])
+        return first, self._bindings[first:self.slot(bindings[-1]) + 1]
+
+    def prepare(self, address, count=1):
+        first, bindings = self._records(address, count)
+        for _ in range(SEQLOCK_RETRIES):
+            if self.shared.load(first, bindings) is not None:
+                break
+        else:
+            raise TornReadError("registers %d to %d are being written"
+                                % (address, address + count - 1))
+        super(YoctopuceSharedBlock, self).prepare(address, count)
+
+    def getValues(self, address, count=1):
+        first, bindings = self._records(address, count)
+        offset = 2 * (address - self.address)
+        for _ in range(SEQLOCK_RETRIES):
+            sequences = self.shared.load(first, bindings)
+            if sequences is None:
+                continue
+            values = list(struct.unpack_from('>%dH' % count, self.image, offset))
+            if sequences == self.shared.sequences(first, len(bindings)):
+                break
+        else:
+            raise TornReadError("registers %d to %d are being written"
+                                % (address, address + count - 1))
+        # the states are loaded, check them as the other blocks do
+        super(YoctopuceSharedBlock, self).prepare(address, count)
+        return self.add_status(address, values)
+
+    def read_image(self, address, count=1):
+        # the registers are only consistent under the sequence locks
+        return None
+
+    def close(self):
+        # requests in flight may still read the segment, it is unmapped
+        # once the block is garbage collected
+        self.shared.shm.unlink()
+
+
+class YoctopuceSparseBlock(YoctopuceDataBlock):
+    """ A data block storing only the registers of its bindings, as a
+    sorted list of segments of contiguous registers, for device maps
+    spread over the address space (e.g. bindings at 0x0000 and 0xF000).
+    The unmapped registers between segments read as 0 and ignore writes.
+    Bindings closer than SEGMENT_GAP registers share a segment, so that
+    most reads are served by slicing a single segment.
+    """
+
+    def _allocate(self, start, length):
+        self.address = start
+        self.default_value = 0
+        self.length = length
+
+    def _build_index(self):
+        super(YoctopuceSparseBlock, self)._build_index()
+        self._segments = []
+        self._segment_starts = []
+        self._slots = {}
+        for start, end in segment_ranges(self._bindings):
+            self._segment_starts.append(start)
+            self._segments.append((start, [0] * (end - start)))
+        for binding in self._bindings:
+            start, values = self._segment(binding.reg_addr)
+            self._slots[binding.reg_addr] = (values, binding.reg_addr - start)
+
+    def _segment(self, address):
+        """ Return the (start, values) segment starting at or before address
+        """
+        return self._segments[bisect.bisect_right(self._segment_starts, address) - 1]
+
+    def validate(self, address, count=1):
+        return self.address <= address and address + count <= self.address + self.length
+
+    def store(self, binding, val):
+        values, offset = self._slots[binding.reg_addr]
+        binding.encode_into(values, offset, val)
+        self.generation += 1
+
+    def getValues(self, address, count=1):
+        self.prepare(address, count)
+        end = address + count
+        first = bisect.bisect_right(self._segment_starts, address) - 1
+        if first >= 0:
+            start, values = self._segments[first]
+            if end <= start + len(values):
+                return self.add_status(address, values[address - start:end - start])
+        result = [self.default_value] * count
+        for start, values in self._segments[max(first, 0):]:
+            if start >= end:
+                break
+            low = max(address, start)
+            high = min(end, start + len(values))
+            if low < high:
+                result[low - address:high - address] = values[low - start:high - start]
+        return self.add_status(address, result)
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        end = address + len(values)
+        first = max(bisect.bisect_right(self._segment_starts, address) - 1, 0)
+        for start, registers in self._segments[first:]:
+            if start >= end:
+                break
+            low = max(address, start)
+            high = min(end, start + len(registers))
+            if low < high:
+                registers[low - start:high - start] = values[low - address:high - address]
+        self.generation += 1
+
+
+def segment_ranges(bindings):
+    """ Merge the registers of bindings sorted by address into segments,
+    bridging the gaps of at most SEGMENT_GAP registers
+
+    :returns: A list of (start, end) register ranges
+    """
+    ranges = []
+    for binding in bindings:
+        end = binding.reg_addr + binding.get_reglen()
+        if ranges and binding.reg_addr <= ranges[-1][1] + SEGMENT_GAP:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([binding.reg_addr, end])
+    return [(start, end) for start, end in ranges]
+
+
+def create_block(devices, image=False, snapshot=False, shared=False):
+    """ Create the data block of a device map: a byte image if requested,
+    else a list of registers, sparse when the registers of the bindings
+    fill less than SPARSE_FILL_RATIO of the range they span.
+
+    :param devices: The device map, as built by YoctopuceStore.build
+    :param image: True to store the registers in a YoctopuceImageBlock
+    :param snapshot: True to publish them in a YoctopuceSnapshotBlock
+    :param shared: True to share them with acquisition processes, in
+                   a YoctopuceSharedBlock
+    """
+    if shared:
+        return YoctopuceSharedBlock(devices)
+    if snapshot:
+        return YoctopuceSnapshotBlock(devices)
+    if image:
+        return YoctopuceImageBlock(devices)
+    bindings = sorted(devices.values(), key=lambda binding: binding.reg_addr)
+    ranges = segment_ranges(bindings)
+    if ranges:
+        span = max(end for start, end in ranges) - ranges[0][0]
+        if sum(end - start for start, end in ranges) < SPARSE_FILL_RATIO * span:
+            log.debug("sparse registers: %d segments over %d registers" % (len(ranges), span))
+            return YoctopuceSparseBlock(devices)
+    return YoctopuceDataBlock(devices)
+
+
+class YoctopuceDerivedBlock(BaseModbusDataBlock):
+    """ Base of the blocks computed from the bindings of a measurement
+    block rather than stored, spanning the same addresses. There is one
+    value per binding, at the address of its first register.
+    """
+
+    def __init__(self, measures):
+        self.measures = measures
+        self.devices = measures.devices
+        self.address = measures.address
+        self.default_value = 0
+
+    @property
+    def read_through(self):
+        return self.measures.read_through
+
+    def validate(self, address, count=1):
+        return self.measures.validate(address, count)
+
+    def value_of(self, binding):
+        raise NotImplementedError()
+
+    def prepare(self, address, count=1):
+        self.measures.prepare(address, count)
+
+    def getValues(self, address, count=1):
+        self.prepare(address, count)
+        values = [self.default_value] * count
+        for binding in self.measures.overlapping(address, count):
+            if binding.reg_addr >= address:
+                values[binding.reg_addr - address] = self.value_of(binding)
+        return values
+
+    def setValues(self, address, values):
+        raise ValueError("%s is read only" % self.__class__.__name__)
+
+
+class YoctopuceAlarmBlock(YoctopuceDerivedBlock):
+    """ Discrete inputs set while the value of their binding is outside of
+    its [low, high] thresholds, derived from the cached measures.
+    """
+
+    def __init__(self, measures):
+        super(YoctopuceAlarmBlock, self).__init__(measures)
+        self.default_value = False
+
+    def value_of(self, binding):
+        return binding.in_alarm()
+
+
+class YoctopuceConfigBlock(YoctopuceDerivedBlock):
+    """ Holding registers exposing the refresh period of each binding in
+    milliseconds. Writing one changes the polling period of the sensor.
+    """
+
+    def prepare(self, address, count=1):
+        # the configuration does not depend on the sensors
+        pass
+
+    def value_of(self, binding):
+        return min(0xffff, int(round(binding.refresh_period * 1000)))
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        for offset, value in enumerate(values):
+            binding = self.devices.get(address + offset)
+            if binding is None:
+                continue
+            if value <= 0:
+                raise ValueError("refresh period of %s must be positive" % binding.get_hwid())
+            binding.refresh_period = value / 1000.0
+
+
+class YoctopuceActuatorBlock(BaseModbusDataBlock):
+    """ Holding registers overlaying actuators on another block: reads and
+    writes at an actuator address go to the actuator, the others to the
+    underlying block. Writes are queued to a YoctopuceWriter so that the
+    response never waits for USB.
+    """
+
+    def __init__(self, base, actuators, writer):
+        self.base = base
+        self.actuators = actuators
+        self.writer = writer
+        self.devices = getattr(base, 'devices', {})
+        self.default_value = 0
+        self._addresses = sorted(actuators.keys())
+        self.address = min(base.address, self._addresses[0])
+
+    @property
+    def read_through(self):
+        return getattr(self.base, 'read_through', False)
+
+    def _runs(self, address, count):
+        """ Split a range into (start, count, actuator) runs, where
+        actuator is None for the runs served by the base block
+        """
+        first = bisect.bisect_left(self._addresses, address)
+        last = bisect.bisect_left(self._addresses, address + count)
+        runs = []
+        for reg in self._addresses[first:last]:
+            if reg > address:
+                runs.append((address, reg - address, None))
+            runs.append((reg, 1, self.actuators[reg]))
+            count -= reg + 1 - address
+            address = reg + 1
+        if count > 0:
+            runs.append((address, count, None))
+        return runs
+
+    def validate(self, address, count=1):
+        return all(actuator is not None or self.base.validate(start, length)
+                   for start, length, actuator in self._runs(address, count))
+
+    def getValues(self, address, count=1):
+        values = []
+        for start, length, actuator in self._runs(address, count):
+            if actuator is None:
+                values.extend(self.base.getValues(start, length))
+            else:
+                values.append(actuator.value)
+        return values
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        for start, length, actuator in self._runs(address, len(values)):
+            chunk = values[start - address:start - address + length]
+            if actuator is None:
+                self.base.setValues(start, chunk)
+            else:
+                self.writer.submit(actuator, chunk[0])
+
+
+def build_slave_context(block, layout='shared', actuators=None, writer=None):
+    """ Build the slave context serving a measurement block
+
+    :param block: The YoctopuceDataBlock of the measures
+    :param layout: 'shared' to serve the measures in every table, 'split'
+                   for measures in the input registers, alarm bits in the
+                   discrete inputs, refresh periods in the holding registers
+                   and no coils
+    :param actuators: Optional actuators overlaid on the holding registers
+    :param writer: The YoctopuceWriter applying the actuator writes
+    :returns: The ModbusSlaveContext
+    """
+    if layout == 'split':
+        holding = YoctopuceConfigBlock(block)
+    else:
+        holding = block
+    if actuators:
+        holding = YoctopuceActuatorBlock(holding, actuators, writer)
+    if layout == 'split':
+        return ModbusSlaveContext(di=YoctopuceAlarmBlock(block), co=ModbusSparseDataBlock(),
+                                  hr=holding, ir=block, zero_mode=True)
+    return ModbusSlaveContext(di=block, co=block, hr=holding, ir=block, zero_mode=True)
+
+
+# --------------------------------------------------------------------------- #
+# pre-encoded register read responses
+# --------------------------------------------------------------------------- #
+
+
+class ResponseCache(object):
+    """ The encoded responses of the register reads of a data block, keyed
+    by (function code, address, count) and valid as long as the generation
+    of the block is unchanged, so that a repeated read needs neither a
+    register list nor a response encoding. A hit still prepares the block
+    when its bindings have a staleness limit or a read demand to account.
+
+    Ranges with status registers, whose age changes on every read, and
+    blocks without generation or read through are not cached.
+    """
+
+    def __init__(self, block):
+        self.block = block
+        self.hits = Counter()
+        self.misses = Counter()
+        self._entries = {}
+        self._bypass = set()
+
+    def read(self, function_code, address, count):
+        """ Return the encoded response of a register read, without its
+        function code
+
+        :param function_code: The function code of the request
+        :param address: The starting address
+        :param count: The number of registers to read
+        :returns: The response bytes, or None if the range is not cached
+        """
+        block = self.block
+        key = (function_code, address, count)
+        # read before the registers, a concurrent store bumps it after
+        generation = block.generation
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == generation:
+            if entry[2]:
+                block.prepare(address, count)
+            self.hits.inc()
+            return entry[1]
+        if generation is None or block.read_through or key in self._bypass:
+            return None
+        bindings = block.overlapping(address, count)
+        if any(binding.status for binding in bindings):
+            self._bypass.add(key)
+            return None
+        self.misses.inc()
+        values = block.getValues(address, count)
+        response = struct.pack('>B%dH' % count, 2 * count, *values)
+        prepare = block.cadence is not None or any(
+            binding.max_staleness > 0 or binding.on_wake is not None for binding in bindings)
+        if len(self._entries) >= RESPONSE_CACHE_SIZE:
+            self._entries.clear()
+        self._entries[key] = (generation, response, prepare)
+        return response
+
+    def hit_ratio(self):
+        total = self.hits.value + self.misses.value
+        return self.hits.value / total if total else 0.0
+
+
+class CachedRegistersResponse(ModbusResponse):
+    """ A register read response encoded by a ResponseCache
+    """
+
+    def __init__(self, function_code, response, **kwargs):
+        super(CachedRegistersResponse, self).__init__(**kwargs)
+        self.function_code = function_code
+        self.response = response
+
+    def encode(self):
+        return self.response
+
+    def decode(self, data):
+        self.response = data
 
-    def encode_value(self, val):
-        builder = BinaryPayloadBuilder(byteorder=Endian.Big)
-        if self.encoding == 'int8':
-            builder.add_8bit_int(int(val))
-        elif self.encoding == 'int16':
-            builder.add_16bit_int(int(val))
-        elif self.encoding == 'int32':
-            builder.add_32bit_int(int(val))
-        elif self.encoding == 'float16':
-            builder.add_16bit_float(val)
-        elif self.encoding == 'float32':
-            builder.add_32bit_float(val)
-        ba = builder.to_registers()
-        return ba
-
-    def update_measure(self, org_val, address, count):
-        end_addr = address + count
-        # skip device that are outside the range
-        if end_addr <= self.reg_addr:
+
+def execute_cached(request, context, execute):
+    """ Serve a register read from the ResponseCache of the block of its
+    table, falling back on the pymodbus implementation
+
+    :param request: The read registers request
+    :param context: The ModbusSlaveContext of the unit
+    :param execute: The execute method of the pymodbus request class
+    :returns: The response
+    """
+    block = context.store.get(context.decode(request.function_code))
+    cache = getattr(block, 'responses', None)
+    if cache is None or not 1 <= request.count <= 0x7d \
+            or not block.validate(request.address, request.count):
+        return execute(request, context)
+    response = cache.read(request.function_code, request.address, request.count)
+    if response is None:
+        return execute(request, context)
+    return CachedRegistersResponse(request.function_code, response)
+
+
+class CachedReadHoldingRegistersRequest(ReadHoldingRegistersRequest):
+
+    def execute(self, context):
+        return execute_cached(self, context, ReadHoldingRegistersRequest.execute)
+
+
+class CachedReadInputRegistersRequest(ReadInputRegistersRequest):
+
+    def execute(self, context):
+        return execute_cached(self, context, ReadInputRegistersRequest.execute)
+
+
+# requests registered with the Modbus servers to use the response caches
+CACHED_REQUESTS = [CachedReadHoldingRegistersRequest, CachedReadInputRegistersRequest]
+
+
+# --------------------------------------------------------------------------- #
+# fast register reads
+# --------------------------------------------------------------------------- #
+
+
+class FastReadPath(object):
+    """ Serves the holding and input register reads of a Modbus TCP
+    connection straight from the register images of the data blocks:
+    the frames are parsed from the receive buffer and the responses built
+    into a preallocated buffer from a memoryview of the image, without any
+    pymodbus request nor response object. The other frames, including the
+    reads of blocks without image and the erroneous reads, are left to
+    pymodbus, along with all the data received after them, so that the
+    responses keep the order of the requests.
+    """
+
+    def __init__(self, context, transport):
+        self.context = context
+        self.transport = transport
+        self._received = bytearray()
+        self._response = bytearray(READ_RESPONSE.size + 2 * MAX_READ_COUNT)
+
+    def feed(self, data):
+        """ Serve the register reads of received data
+
+        :param data: The bytes received
+        :returns: The data left to pymodbus, possibly empty: the data from
+                  the first frame not served on
+        """
+        received = self._received
+        received += data
+        others = bytearray()
+        pos = 0
+        while len(received) - pos >= MBAP_HEADER.size:
+            length = MBAP_HEADER.unpack_from(received, pos)[2]
+            if not 2 <= length <= 254:
+                # not a frame, let the pymodbus framer resynchronize
+                others += received[pos:]
+                pos = len(received)
+                break
+            end = pos + 6 + length
+            if end > len(received):
+                break
+            if length != 6 or received[pos + 7] not in (3, 4) or not self._serve(received, pos):
+                # pymodbus answers it later, and so the frames after it
+                others += received[pos:]
+                pos = len(received)
+                break
+            pos = end
+        del received[:pos]
+        return others
+
+    def _serve(self, received, pos):
+        tid, protocol, length, unit, function_code, address, count = \
+            READ_REQUEST.unpack_from(received, pos)
+        if protocol != 0 or not 1 <= count <= MAX_READ_COUNT:
+            return False
+        try:
+            slave = self.context[unit]
+        except NoSuchSlaveException:
+            return False
+        block = slave.store[slave.decode(function_code)]
+        read_image = getattr(block, 'read_image', None)
+        if read_image is None or not block.validate(address, count):
+            return False
+        try:
+            registers = read_image(address, count)
+        except Exception:
+            # e.g. stale values, answered by pymodbus with an exception
+            return False
+        if registers is None:
+            return False
+        size = 2 * count
+        response = self._response
+        READ_RESPONSE.pack_into(response, 0, tid, 0, 3 + size, unit, function_code, size)
+        response[READ_RESPONSE.size:READ_RESPONSE.size + size] = registers
+        self.transport.write(memoryview(response)[:READ_RESPONSE.size + size])
+        if self.transport.get_write_buffer_size():
+            # the transport may keep a view of the unsent response
+            self._response = bytearray(len(response))
+        return True
+
+
+# --------------------------------------------------------------------------- #
+# background acquisition
+# --------------------------------------------------------------------------- #
+
+
+def read_measures(bindings):
+    """ Read the sensors of a list of bindings, skipping failures
+
+    :param bindings: The YocotpuceBinding objects to read
+    :returns: A list of (binding, value) pairs
+    """
+    measures = []
+    for binding in bindings:
+        try:
+            val = binding.read_value()
+        except Exception as ex:
+            log.error("unable to refresh %s: %s" % (binding.get_hwid(), ex))
+            continue
+        if val is not None:
+            measures.append((binding, val))
+    return measures
+
+
+def unacquired(devices):
+    return [binding for binding in devices.values() if binding.timestamp is None]
+
+
+def store_measures(block, measures):
+    try:
+        block.store_many(measures)
+    except Exception as ex:
+        log.error("unable to store measures: %s" % ex)
+
+
+class ReadCadence(object):
+    """ The polling periods of the Modbus masters, learnt from the ranges
+    of registers they read. Requests carry no client identity, a range is
+    assumed to be read by a single master at a fixed period.
+
+    The period of a range is the moving average of the intervals between
+    its reads, it is known once CADENCE_SAMPLES intervals matched it and
+    forgotten after CADENCE_MISSES periods without read. The reads are
+    predicted twice their average deviation early, so that a master
+    reading a bit early still gets the prefetched value.
+
+    Once MAX_CADENCE_RANGES ranges are tracked, the forgotten ones are
+    evicted, along with the least recently read of the ranges without
+    known period, down to half the table.
+    """
+
+    def __init__(self):
+        # (address, count) -> [last read, period, matching intervals, jitter,
+        #                      register addresses of the bindings]
+        self._ranges = {}
+        # register address of a binding -> keys of the ranges reading it
+        self._by_reg = {}
+
+    def observe(self, address, count, now, bindings):
+        """ Record a read of the registers of some bindings
+
+        :param address: The starting address of the request
+        :param count: The number of registers requested
+        :param now: The time of the request
+        :param bindings: The bindings overlapping the requested registers
+        """
+        key = (address, count)
+        state = self._ranges.get(key)
+        if state is None:
+            if len(self._ranges) >= MAX_CADENCE_RANGES:
+                self._evict(now)
+                if len(self._ranges) >= MAX_CADENCE_RANGES:
+                    return
+            regs = tuple(binding.reg_addr for binding in bindings)
+            self._ranges[key] = [now, None, 0, 0.0, regs]
+            for reg in regs:
+                self._by_reg[reg] = self._by_reg.get(reg, ()) + (key,)
             return
-        if address > (self.reg_addr + self.reg_len):
+        interval = now - state[0]
+        period = state[1]
+        if period is not None and abs(interval - period) <= CADENCE_TOLERANCE * period:
+            state[1] = period + (interval - period) / 4
+            state[2] += 1
+            state[3] += (abs(interval - period) - state[3]) / 4
+        elif period is not None and interval < CADENCE_TOLERANCE * period:
+            # a retry or a second read within the same poll
             return
-        # get sensor values
-        val = self.ysensor.get_currentValue()
-        full_register = self.encode_value(val)
-        # and update the corresponding register
-        offset = self.reg_addr
-        for word in full_register:
-            org_val[offset] = word
-            offset += 1
+        else:
+            state[1] = interval
+            state[2] = 0
+            state[3] = 0.0
+        state[0] = now
 
-    def get_hwid(self):
-        return self.hwid
+    def _evict(self, now):
+        kept = []
+        learning = []
+        for key, state in list(self._ranges.items()):
+            last, period, matches = state[:3]
+            if matches < CADENCE_SAMPLES:
+                learning.append((last, key, state))
+            elif now - last <= CADENCE_MISSES * period:
+                kept.append((key, state))
+        learning.sort(key=lambda item: item[0])
+        room = max(0, MAX_CADENCE_RANGES // 2 - len(kept))
+        kept.extend((key, state) for last, key, state in learning[len(learning) - room:])
+        by_reg = {}
+        for key, state in kept:
+            for reg in state[4]:
+                by_reg[reg] = by_reg.get(reg, ()) + (key,)
+        # replaced rather than updated, next_read may run meanwhile
+        self._ranges = dict(kept)
+        self._by_reg = by_reg
+
+    def next_read(self, binding, after):
+        """ Predict the next read of a binding
+
+        :param binding: The binding
+        :param after: The earliest time of the prediction, the reads
+                      expected within the jitter of that time are skipped:
+                      they are the ones just prefetched
+        :returns: The time of the next read of its ranges with a known
+                  period, or None if none of them is polled periodically
+        """
+        best = None
+        ranges = self._ranges
+        for key in self._by_reg.get(binding.reg_addr, ()):
+            state = ranges.get(key)
+            if state is None:
+                continue
+            last, period, matches, jitter = state[:4]
+            if matches < CADENCE_SAMPLES or after - last > CADENCE_MISSES * period:
+                continue
+            guard = after + CADENCE_TOLERANCE * period
+            # early by at most the guard, so that the read stays after after
+            early = min(2 * jitter, CADENCE_TOLERANCE * period)
+            expected = last + (int((guard - last) / period) + 1) * period - early
+            if best is None or expected < best:
+                best = expected
+        return best
+
+
+class PollSchedule(object):
+    """ The next refresh time of each binding of a device map, kept in a
+    heap so that the bindings due at the same time are refreshed in a
+    single acquisition pass.
+
+    With an idle time, the bindings no request read for that long are
+    idle: polled every idle_period seconds, or parked if idle_period is
+    0, until wake() puts them back on their own refresh period. A heap
+    entry is ignored once the version of its binding changed.
+
+    With a ReadCadence, the bindings read periodically are refreshed
+    just before their next expected read instead, lead seconds ahead:
+    the time the prefetches took from their due time to the end of
+    their pass, including the wait for other passes.
+    """
+
+    def __init__(self, devices, idle=0, idle_period=0, cadence=None):
+        self.devices = devices
+        self.idle = idle
+        self.idle_period = idle_period
+        self.cadence = cadence
+        self.lead = PREFETCH_MARGIN
+        self._prefetch_due = None
+        now = time.monotonic()
+        self._versions = dict((key, 0) for key in devices)
+        self._keys = {}
+        for key, item in devices.items():
+            for binding in self._members(item):
+                binding.idle = False
+                self._keys[binding.reg_addr] = key
+        self._heap = [(now + item.refresh_period, key, 0) for key, item in devices.items()]
+        heapq.heapify(self._heap)
+
+    def _members(self, item):
+        return [item]
+
+    def record_pass(self, now):
+        """ Account the end of the acquisition pass of the last pop_due()
+        in the lead time of the prefetches, growing it at once when a
+        prefetch ended late and shrinking it slowly otherwise
+        """
+        if self._prefetch_due is None:
+            return
+        lead = now - self._prefetch_due + PREFETCH_MARGIN
+        self._prefetch_due = None
+        if lead > self.lead:
+            self.lead = lead
+        else:
+            self.lead += (lead - self.lead) / 8
+
+    def _prefetch_time(self, item, now):
+        best = None
+        for binding in self._members(item):
+            expected = self.cadence.next_read(binding, now + self.lead)
+            if expected is not None and (best is None or expected < best):
+                best = expected
+        return None if best is None else best - self.lead
+
+    def _in_demand(self, item, now):
+        for binding in self._members(item):
+            if binding.last_read is not None and now - binding.last_read <= self.idle:
+                return True
+        return False
+
+    def delay(self, now):
+        """ Return the time to wait before the next binding is due
+        """
+        if not self._heap:
+            return 3600.0
+        return self._heap[0][0] - now
+
+    def pop_due(self, now):
+        """ Return the bindings due at time now and schedule their next
+        refresh. Missed periods are skipped rather than caught up.
+        """
+        batch = []
+        heap = self._heap
+        self._prefetch_due = None
+        while heap and heap[0][0] <= now:
+            due, key, version = heap[0]
+            if version != self._versions[key]:
+                heapq.heappop(heap)
+                continue
+            item = self.devices[key]
+            period = item.refresh_period
+            prefetch = None if self.cadence is None else self._prefetch_time(item, now)
+            if prefetch is not None:
+                if self._prefetch_due is None:
+                    self._prefetch_due = due
+                batch.append(item)
+                # every entry is rescheduled after now, so that none is
+                # popped twice by a pass
+                heapq.heapreplace(heap, (max(prefetch, now + PREFETCH_MARGIN), key, version))
+                continue
+            if self.idle and not self._in_demand(item, now):
+                for binding in self._members(item):
+                    binding.idle = True
+                if not self.idle_period:
+                    heapq.heappop(heap)
+                    continue
+                period = max(period, self.idle_period)
+            batch.append(item)
+            due += period
+            if due <= now:
+                due = now + period
+            heapq.heapreplace(heap, (due, key, version))
+        return batch
+
+    def wake(self, binding, now):
+        """ Poll an idle binding on its refresh period again, starting now
+        """
+        key = self._keys.get(binding.reg_addr)
+        if key is None or not binding.idle:
+            return
+        for member in self._members(self.devices[key]):
+            member.idle = False
+        self._versions[key] += 1
+        heapq.heappush(self._heap, (now, key, self._versions[key]))
+
+
+class BindingGroup(object):
+    """ Bindings refreshed together, at the shortest of their periods,
+    which may be changed by the holding registers of --layout split
+    """
+
+    def __init__(self, bindings):
+        self.bindings = bindings
+
+    @property
+    def refresh_period(self):
+        return min(binding.refresh_period for binding in self.bindings)
+
+
+class ModulePollSchedule(PollSchedule):
+    """ A PollSchedule refreshing all the bindings of a module in the same
+    acquisition pass. Reading the functions of a module back to back
+    costs a single device request, the Yoctopuce library serving them
+    from the same short lived cache of the device API.
+    """
+
+    def __init__(self, devices, idle=0, idle_period=0, cadence=None):
+        modules = {}
+        for binding in devices.values():
+            modules.setdefault(binding.get_module(), []).append(binding)
+        super(ModulePollSchedule, self).__init__(
+            dict((module, BindingGroup(bindings)) for module, bindings in modules.items()),
+            idle, idle_period, cadence)
+
+    def _members(self, group):
+        return group.bindings
+
+    def pop_due(self, now):
+        return [binding for group in super(ModulePollSchedule, self).pop_due(now)
+                for binding in group.bindings]
+
+
+class YoctopucePoller(threading.Thread):
+    """ A thread that refreshes every binding of a data block on its own
+    refresh period, so that the Modbus request path only reads cached
+    registers and never waits for USB.
+    """
+
+    def __init__(self, block, devices=None, name="yoctopuce-poller", schedule=PollSchedule,
+                 idle=0, idle_period=0):
+        super(YoctopucePoller, self).__init__(name=name)
+        self.daemon = True
+        self.block = block
+        self.devices = block.devices if devices is None else devices
+        self.schedule = schedule
+        self.idle = idle
+        self.idle_period = idle_period
+        self.ready = threading.Event()
+        self._halt = threading.Event()
+        self._wakeup = threading.Event()
+        self._woken = []
+
+    def wake(self, binding):
+        """ Poll an idle binding again, called from the request path
+        """
+        self._woken.append(binding)
+        self._wakeup.set()
+
+    def refresh_new(self):
+        """ Acquire the bindings that were never acquired, the others are
+        kept by a device map reload along with their cached value
+        """
+        self._refresh(unacquired(self.devices))
+
+    def _refresh(self, bindings):
+        store_measures(self.block, read_measures(bindings))
+
+    def run(self):
+        # set before serving, the response caches tell from it whether
+        # the reads of a binding must be accounted
+        if self.idle:
+            for binding in self.devices.values():
+                binding.on_wake = self.wake
+        self.refresh_new()
+        self.ready.set()
+        schedule = self.schedule(self.devices, self.idle, self.idle_period, self.block.cadence)
+        while not self._halt.is_set():
+            if self._woken:
+                woken, self._woken = self._woken, []
+                now = time.monotonic()
+                for binding in woken:
+                    schedule.wake(binding, now)
+            delay = schedule.delay(time.monotonic())
+            if delay > 0:
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                continue
+            self._refresh(schedule.pop_due(time.monotonic()))
+            schedule.record_pass(time.monotonic())
+
+    def stop(self):
+        self._halt.set()
+        self._wakeup.set()
+
+
+class YoctopuceEventPump(threading.Thread):
+    """ A thread that registers sensor callbacks for every binding of
+    some data blocks and pumps the YAPI events, so that the devices push
+    their values at their own rate without any polling.
+    """
+
+    def __init__(self, blocks, interval=0.01):
+        super(YoctopuceEventPump, self).__init__(name="yoctopuce-events")
+        self.daemon = True
+        self.blocks = blocks
+        self.interval = interval
+        self.ready = threading.Event()
+        self._halt = threading.Event()
+
+    def _bindings(self):
+        for block in self.blocks:
+            for binding in block.devices.values():
+                yield block, binding
+
+    def _uses_yapi(self):
+        return any(binding.backend == 'yoctopuce' for block, binding in self._bindings())
+
+    def _removed(self, module):
+        serial = module.get_serialNumber()
+        log.warning("%s has been unplugged" % serial)
+        for block, binding in self._bindings():
+            if binding.serial == serial:
+                binding.timestamp = None
+                # the cached responses of its registers must fail now
+                block.generation += 1
+
+    def run(self):
+        errmsg = YRefParam()
+        uses_yapi = self._uses_yapi()
+        if uses_yapi:
+            YAPI.RegisterDeviceRemovalCallback(self._removed)
+        simulated = []
+        for block, binding in self._bindings():
+            binding.get_serial()
+            binding.start_events(block)
+            if hasattr(binding.ysensor, 'handle_events'):
+                simulated.append(binding.ysensor)
+        # ready once every sensor pushed a value, or failed to in time
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while not self._halt.is_set():
+            if uses_yapi:
+                YAPI.Sleep(int(self.interval * 1000), errmsg)
+            else:
+                self._halt.wait(self.interval)
+            now = time.monotonic()
+            for sensor in simulated:
+                sensor.handle_events(now)
+            if not self.ready.is_set() and (now >= deadline or all(
+                    binding.timestamp is not None for block, binding in self._bindings())):
+                self.ready.set()
+        for block, binding in self._bindings():
+            binding.stop_events()
+
+    def stop(self):
+        self._halt.set()
+
+
+class YoctopuceWriter(threading.Thread):
+    """ A thread applying the actuator writes in background. Writes
+    submitted within the batching window are applied together, grouped by
+    module, and only the last value written to a register is applied.
+    """
+
+    def __init__(self, actuators, window=0.01):
+        super(YoctopuceWriter, self).__init__(name="yoctopuce-writer")
+        self.daemon = True
+        self.actuators = actuators
+        self.window = window
+        self._pending = {}
+        self._loading = list(actuators.values())
+        self._cond = threading.Condition()
+        self._halt = False
+
+    def update(self, actuators):
+        """ Replace the actuators, e.g. after a device map reload. The new
+        ones are read back before the next writes are applied.
+
+        :param actuators: The new dictionary of actuators
+        """
+        with self._cond:
+            known = set(map(id, self.actuators.values()))
+            self._loading.extend(actuator for actuator in actuators.values()
+                                 if id(actuator) not in known)
+            self.actuators = actuators
+            self._cond.notify()
+
+    def _load(self, actuators):
+        for actuator in actuators:
+            try:
+                value = actuator.read_state()
+            except Exception as ex:
+                log.error("unable to read back %s: %s" % (actuator.hwid, ex))
+                continue
+            with self._cond:
+                # a write submitted meanwhile is the state to come
+                if value is not None and id(actuator) not in self._pending:
+                    actuator.value = value
+
+    def submit(self, actuator, value):
+        """ Queue a write, served as the register value from now on
+
+        :param actuator: The YoctopuceActuator to write
+        :param value: The register value
+        """
+        with self._cond:
+            actuator.value = value
+            self._pending[id(actuator)] = (actuator, value)
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._loading and not self._halt:
+                    self._cond.wait()
+                if self._halt:
+                    return
+                loading = self._loading
+                self._loading = []
+            self._load(loading)
+            if not self._pending:
+                continue
+            # let the writes of the same request or burst accumulate
+            time.sleep(self.window)
+            with self._cond:
+                batch = list(self._pending.values())
+                self._pending.clear()
+            batch.sort(key=lambda write: write[0].get_module())
+            for actuator, value in batch:
+                try:
+                    actuator.apply(value)
+                except Exception as ex:
+                    log.error("unable to write %s: %s" % (actuator.hwid, ex))
+
+    def stop(self):
+        with self._cond:
+            self._halt = True
+            self._cond.notify()
+
+
+class SharedRegistersWriter(object):
+    """ The data block of an acquisition process, storing the measures
+    of its bindings into SharedRegisters
+    """
+
+    def __init__(self, shared, address, devices, slots):
+        self.shared = shared
+        self.address = address
+        self.devices = devices
+        self.read_through = False
+        self.cadence = None
+        self._slots = slots
+
+    def store(self, binding, val):
+        offset = 2 * (binding.reg_addr - self.address)
+        self.shared.write(self._slots[binding.reg_addr], offset, binding.pack_value(val), binding)
+
+    def touch(self, binding):
+        self.shared.write(self._slots[binding.reg_addr], 0, None, binding)
+
+    def store_many(self, measures):
+        stored = set()
+        for binding, val in measures:
+            binding.store_measure(self, val)
+            stored.add(binding.reg_addr)
+        # report the failed reads of the other bindings
+        for reg, binding in self.devices.items():
+            if reg not in stored and binding.read_failed:
+                self.shared.write(self._slots[reg], 0, None, binding)
+
+
+def run_acquisition_process(name, address, length, count, lines, hub, ready, halt, log_level):
+    """ The main function of a YoctopuceProcess: poll the bindings of a
+    hub into the SharedRegisters of the server until halted or orphaned
+    """
+    log.setLevel(log_level)
+    shared = SharedRegisters.attach(name, length, count)
+    devices = {}
+    slots = {}
+    for (regno, hwid, encoding, options), slot in lines:
+        devices[regno] = YocotpuceBinding(regno, hwid, encoding, **options)
+        slots[regno] = slot
+    if any(binding.backend == 'yoctopuce' for binding in devices.values()):
+        register_hubs([hub])
+    poller = YoctopucePoller(SharedRegistersWriter(shared, address, devices, slots),
+                             name="yoctopuce-poller-%s" % hub)
+    poller.start()
+    poller.ready.wait()
+    ready.set()
+    parent = multiprocessing.parent_process()
+    while not halt.wait(1.0):
+        if parent is not None and not parent.is_alive():
+            break
+    poller.stop()
+    poller.join()
+    shared.close()
+
+
+class YoctopuceProcess(object):
+    """ An acquisition process polling the sensors of one hub into the
+    shared registers of a YoctopuceSharedBlock, so that acquisition and
+    the Modbus server run on different cores. Processes are spawned
+    rather than forked, so that they do not inherit the YAPI state nor
+    the threads of the server.
+    """
+
+    def __init__(self, block, devices, hub):
+        context = multiprocessing.get_context('spawn')
+        self.name = "yoctopuce-process-%s" % hub
+        self.ready = context.Event()
+        self._halt = context.Event()
+        lines = [(binding.definition, block.slot(binding)) for binding in devices.values()]
+        self._process = context.Process(
+            target=run_acquisition_process, name=self.name, daemon=True,
+            args=(block.shared.shm.name, block.address, block.length, block.shared.count,
+                  lines, hub, self.ready, self._halt, log.getEffectiveLevel()))
+
+    def start(self):
+        self._process.start()
+
+    def stop(self):
+        self._halt.set()
+
+    def join(self):
+        self._process.join()
 
-    def get_reglen(self):
-        return self.reg_len
+
+def group_by_hub(devices):
+    """ Split a device map by hub
+
+    :param devices: The device map, as built by YoctopuceStore.build
+    :returns: A dictionary of device maps indexed by hub url
+    """
+    hubs = {}
+    for reg, binding in devices.items():
+        hubs.setdefault(binding.hub, {})[reg] = binding
+    return hubs
+
+
+def start_acquisition(blocks, mode, idle=0, idle_period=0, prefetch=False):
+    """ Start the acquisition of the sensors of some data blocks
+
+    :param blocks: The list of YoctopuceDataBlock to feed
+    :param mode: 'poll' for a background poller per hub of each block,
+                 'snapshot' to poll all the sensors of a module at once,
+                 'process' for an acquisition process per hub,
+                 'event' for sensor callbacks, 'sync' to read the sensors
+                 on each request
+    :param idle: Poll the bindings no request read for idle seconds
+                 every idle_period seconds, or not at all if it is 0, see
+                 PollSchedule. Only for the poll and snapshot modes.
+    :param prefetch: Refresh the bindings read periodically just before
+                     their next expected read, see ReadCadence. Only for
+                     the poll and snapshot modes.
+    :returns: The list of running acquisition threads
+    """
+    for block in blocks:
+        block.read_through = mode == 'sync'
+        if prefetch and mode in ('poll', 'snapshot'):
+            block.cadence = ReadCadence()
+    if mode == 'poll':
+        # one poller per hub, a slow or offline hub only delays its own sensors
+        workers = [YoctopucePoller(block, devices, name="yoctopuce-poller-%s" % hub,
+                                   idle=idle, idle_period=idle_period)
+                   for block in blocks
+                   for hub, devices in group_by_hub(block.devices).items()]
+    elif mode == 'snapshot':
+        workers = [YoctopucePoller(block, devices, name="yoctopuce-snapshot-%s" % hub,
+                                   schedule=ModulePollSchedule, idle=idle,
+                                   idle_period=idle_period)
+                   for block in blocks
+                   for hub, devices in group_by_hub(block.devices).items()]
+    elif mode == 'process':
+        workers = [YoctopuceProcess(block, devices, hub)
+                   for block in blocks
+                   for hub, devices in group_by_hub(block.devices).items()]
+    elif mode == 'event':
+        workers = [YoctopuceEventPump(blocks)]
+    else:
+        return []
+    for worker in workers:
+        worker.start()
+    # give the workers a chance to fill the registers before serving
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    for worker in workers:
+        if not worker.ready.wait(max(0, deadline - time.monotonic())):
+            log.warning("%s is not ready yet" % worker.name)
+    return workers
+
+
+def stop_workers(workers):
+    """ Stop acquisition workers, waiting for the threads to exit
+
+    :param workers: Threads, or asyncio tasks, as returned by start_acquisition
+    """
+    for worker in workers:
+        if isinstance(worker, asyncio.Future):
+            worker.cancel()
+        else:
+            worker.stop()
+    for worker in workers:
+        if not isinstance(worker, asyncio.Future):
+            worker.join()
+
+
+async def poll_sensors(block, devices, executor, ready=None, idle=0, idle_period=0,
+                       prefetch=False):
+    """ The asyncio flavour of YoctopucePoller: the sensors are read in
+    an executor while the measures are stored from the event loop, so
+    requests served by the loop never wait for USB nor see a half
+    written acquisition pass.
+
+    :param block: The YoctopuceDataBlock to feed
+    :param devices: The bindings to poll, usually those of one hub
+    :param executor: The executor performing the USB reads
+    :param ready: An optional asyncio.Event set after the first pass
+    :param idle: The idle time of the bindings, see PollSchedule
+    :param idle_period: The refresh period of the idle bindings
+    :param prefetch: Refresh the bindings just before their next
+                     expected read, see ReadCadence
+    """
+    loop = asyncio.get_event_loop()
+    if prefetch and block.cadence is None:
+        block.cadence = ReadCadence()
+    # requests are served by the event loop, they wake idle bindings directly
+    wakeup = asyncio.Event()
+    woken = []
+
+    def wake(binding):
+        woken.append(binding)
+        wakeup.set()
+    if idle:
+        for binding in devices.values():
+            binding.on_wake = wake
+    measures = await loop.run_in_executor(executor, read_measures, unacquired(devices))
+    store_measures(block, measures)
+    if ready is not None:
+        ready.set()
+    schedule = PollSchedule(devices, idle, idle_period, block.cadence)
+    while True:
+        now = time.monotonic()
+        while woken:
+            schedule.wake(woken.pop(), now)
+        delay = schedule.delay(time.monotonic())
+        if delay > 0:
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            continue
+        bindings = schedule.pop_due(time.monotonic())
+        measures = await loop.run_in_executor(executor, read_measures, bindings)
+        store_measures(block, measures)
+        schedule.record_pass(time.monotonic())
 
 
 # --------------------------------------------------------------------------- #
-# create your custom data block with callbacks
+# metrics, exposed in the Prometheus text format
 # --------------------------------------------------------------------------- #
 
+# upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
 
-class YoctopuceDataBlock(ModbusSequentialDataBlock):
-    """ A datablock that stores the new value in memory
-    and performs a custom action after it has been stored.
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(object):
+    """ A value computed when the metrics are rendered
     """
 
-    def __init__(self, devices):
-        self.devices = devices
-        start = 0xffff
-        end = 0
-        for reg in devices.keys():
-            reglen = devices[reg].get_reglen()
-            if reg < start:
-                start = reg
-            if reg + reglen > end:
-                end = reg + reglen
-        values = [0] * (end - start)
-        super(YoctopuceDataBlock, self).__init__(start, values)
+    def __init__(self):
+        self.function = lambda: 0
 
-    def getValues(self, address, count=1):
-        for reg in self.devices.keys():
-            self.devices[reg].update_measure(self.values, address, count)
-        values = super(YoctopuceDataBlock, self).getValues(address, count)
-        return values
+    def samples(self, name, labels):
+        yield name, labels, self.function()
+
+
+class Histogram(object):
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            yield name + '_bucket', labels + (('le', str(bound)),), total
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, total
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                            .replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metrics(object):
+    """ A registry of counters and histograms, and the instrumentation of
+    the data blocks and bindings feeding them. Instrumented objects get
+    timed wrappers of their methods, the others run untouched. Updates
+    are not locked, a concurrent increment may rarely be lost.
+    """
+
+    def __init__(self):
+        self._families = {}
+
+    def _metric(self, kind, name, help, labels):
+        family = self._families.setdefault(name, (kind.__name__.lower(), help, {}))
+        key = tuple(sorted(labels.items()))
+        if key not in family[2]:
+            family[2][key] = kind()
+        return family[2][key]
+
+    def counter(self, name, help, **labels):
+        return self._metric(Counter, name, help, labels)
+
+    def histogram(self, name, help, **labels):
+        return self._metric(Histogram, name, help, labels)
+
+    def gauge(self, name, help, **labels):
+        return self._metric(Gauge, name, help, labels)
+
+    def render(self):
+        lines = []
+        for name in sorted(self._families):
+            kind, help, metrics = self._families[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, metric in sorted(metrics.items()):
+                for sample, sample_labels, value in metric.samples(name, labels):
+                    lines.append('%s%s %s' % (sample, format_labels(sample_labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def instrument_block(self, block, table='shared'):
+        """ Time the reads of a data block and count the requests and
+        registers served
+        """
+        requests = self.counter('ymodbus_requests_total', 'Register reads served', table=table)
+        registers = self.counter('ymodbus_registers_read_total', 'Registers read', table=table)
+        errors = self.counter('ymodbus_request_errors_total', 'Register reads failed', table=table)
+        duration = self.histogram('ymodbus_read_seconds', 'Register read duration', table=table)
+        get_values = block.getValues
+        clock = time.perf_counter
+
+        def getValues(address, count=1):
+            start = clock()
+            try:
+                values = get_values(address, count)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                duration.observe(clock() - start)
+            requests.inc()
+            registers.inc(count)
+            return values
+        block.getValues = getValues
+        for binding in block.devices.values():
+            self.instrument_binding(binding)
+
+    def instrument_cache(self, cache, table='shared'):
+        """ Count the hits and misses of a ResponseCache, the counters of
+        the caches of every unit and map version being shared
+        """
+        cache.hits = hits = self.counter('ymodbus_response_cache_hits_total',
+                                         'Register reads served from a cached response',
+                                         table=table)
+        cache.misses = misses = self.counter('ymodbus_response_cache_misses_total',
+                                             'Register reads encoded into the response cache',
+                                             table=table)
+        ratio = self.gauge('ymodbus_response_cache_hit_ratio',
+                           'Ratio of the cacheable register reads served from the cache',
+                           table=table)
+        ratio.function = lambda: hits.value / max(hits.value + misses.value, 1)
+
+    def instrument_binding(self, binding):
+        """ Time the sensor reads of a binding and count its failures
+        """
+        if getattr(binding, '_instrumented', False):
+            return
+        binding._instrumented = True
+        errors = self.counter('ymodbus_sensor_errors_total', 'Sensor reads failed',
+                              sensor=binding.get_hwid())
+        duration = self.histogram('ymodbus_sensor_read_seconds', 'Sensor read duration',
+                                  sensor=binding.get_hwid())
+        read_value = binding.read_value
+        clock = time.perf_counter
+
+        def timed_read_value():
+            start = clock()
+            try:
+                val = read_value()
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                duration.observe(clock() - start)
+            if val is None:
+                errors.inc()
+            return val
+        binding.read_value = timed_read_value
+
+
+def serve_metrics(metrics, port, host="localhost"):
+    """ Serve the metrics on http://host:port/metrics from a daemon thread
+
+    :param metrics: The Metrics registry to expose
+    :param port: The TCP port to listen on
+    :param host: The interface to listen on, local only by default
+    :returns: The running HTTP server
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug("metrics: " + format % args)
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    return httpd
 
 
 # --------------------------------------------------------------------------- #
@@ -119,45 +2667,461 @@ class YoctopuceDataBlock(ModbusSequentialDataBlock):
 # --------------------------------------------------------------------------- #
 
 
-def read_device_map(path):
-    """ A helper method to read the device
-    path to address mapping from file::
+def parse_device_map(path, hub='usb', backend=None):
+    """ Parse the lines of a device mapping file, which map registers to
+    sensors or actuators (whose encoding column is the kind of actuator)::
 
-       0x0001,/dev/device1
-       0x0002,/dev/device2
+       0x0001,/dev/device1,int16
+       0x0002,/dev/device2,float32,refresh=0.1,stale=2
+       0x0100,RELAYLO1-12345.relay1,relay
+
+    Optional key=value columns after the encoding tune the acquisition:
+    refresh is the polling period and stale the maximal age of a served
+    value, both in seconds, hub the url of the hub of the sensor, backend
+    the sensor backend (see open_sensor) and unit the Modbus unit id of
+    the line (see YoctopuceStore).
 
     :param path: The path to the input file
-    :returns: The input mapping file
+    :param hub: The hub of the lines that do not specify one
+    :param backend: The backend of the lines that do not specify one
+    :returns: A list of (register, hwid, encoding, options) tuples
     """
-    devices = {}
+    lines = []
     with open(path, 'r') as stream:
         for line in stream:
-            piece = line.strip().split(',')
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            piece = line.split(',')
             hwid = piece[1]
             regno = int(piece[0], 16)
-            devices[regno] = YocotpuceBinding(regno, hwid, piece[2])
-    return devices
+            options = dict(opt.strip().split('=', 1) for opt in piece[3:])
+            options.setdefault('hub', hub)
+            if backend is not None:
+                options.setdefault('backend', backend)
+            lines.append((regno, hwid, piece[2], options))
+    return lines
+
+
+def register_hubs(hubs):
+    """ Setup the API to use the given hubs. Local USB devices must be
+    available, network hubs are connected in background so that an
+    offline hub does not prevent the server from starting.
+
+    :param hubs: The list of hub urls
+    """
+    errmsg = YRefParam()
+    for url in hubs:
+        if is_simulated_hub(url):
+            continue
+        if url == "usb":
+            if YAPI.RegisterHub(url, errmsg) != YAPI.SUCCESS:
+                sys.exit("init error" + str(errmsg))
+        elif YAPI.PreregisterHub(url, errmsg) != YAPI.SUCCESS:
+            log.error("unable to register hub %s: %s" % (url, errmsg.value))
+
+
+# --------------------------------------------------------------------------- #
+# data store, rebuilt when the device map changes
+# --------------------------------------------------------------------------- #
+
+
+class ModbusUnit(object):
+    """ The functions of the device map served under one unit id, with
+    their data block and slave context
+    """
+
+    def __init__(self, devices, actuators, block, slave):
+        self.devices = devices
+        self.actuators = actuators
+        self.block = block
+        self.slave = slave
+
+
+class DeviceMapVersion(object):
+    """ What is built from one version of the device map
+    """
+
+    def __init__(self, functions, units, single):
+        # bindings and actuators indexed by their device map line
+        self.functions = functions
+        # ModbusUnit indexed by unit id
+        self.units = units
+        # True when the map has no unit column, every unit id is served
+        self.single = single
+
+    def blocks(self):
+        return [unit.block for unit in self.units.values()]
+
+    def actuators(self):
+        return dict(((unit_id, reg), actuator) for unit_id, unit in self.units.items()
+                    for reg, actuator in unit.actuators.items())
+
+    def describe(self):
+        return "%d sensors, %d actuators, %s" % (
+            sum(len(unit.devices) for unit in self.units.values()),
+            sum(len(unit.actuators) for unit in self.units.values()),
+            "single unit" if self.single else "units %s" % sorted(self.units))
+
+
+class YoctopuceStore(object):
+    """ The data store served for a device map: its bindings and
+    actuators, the data blocks holding their registers and the workers
+    acquiring them. A reload builds the new blocks and slave contexts off
+    the request path, starts their acquisition, then swaps the slave
+    contexts in at once, so that requests see either map but never a
+    half built one. Unchanged lines keep their binding, hence their
+    cached value.
+
+    The lines of the device map with a unit option are served under
+    that Modbus unit id, each unit by a slave context and a block of its
+    own, sized to its own bindings. A map without unit option is served
+    under any unit id, as a single slave.
+    """
+
+    def __init__(self, map_path, acquisition='poll', image=False, layout='shared',
+                 hubs=("usb",), backend=None, metrics=None, read_threads=0,
+                 idle=0, idle_period=0, prefetch=False, response_cache=False):
+        self.map_path = map_path
+        self.acquisition = acquisition
+        self.image = image
+        self.layout = layout
+        self.hubs = list(hubs)
+        self.backend = backend
+        self.metrics = metrics
+        self.idle = idle
+        self.idle_period = idle_period
+        self.prefetch = prefetch
+        self.response_cache = response_cache
+        self.read_pool = None
+        if read_threads and acquisition == 'sync':
+            self.read_pool = ThreadPoolExecutor(max_workers=read_threads,
+                                                thread_name_prefix="yoctopuce-read")
+        self.writer = None
+        self.workers = []
+        self._registered = set()
+        self._executors = {}
+        self.current = self.build(DeviceMapVersion({}, {}, True))
+        if self.current.single:
+            self.context = ModbusServerContext(slaves=self.current.units[DEFAULT_UNIT].slave,
+                                               single=True)
+        else:
+            self.context = ModbusServerContext(
+                slaves=dict((unit_id, unit.slave) for unit_id, unit in self.current.units.items()),
+                single=False)
+
+    def _register_hubs(self, functions):
+        if self.acquisition == 'process':
+            # the sensors are read by the acquisition processes, and the
+            # local USB devices can only be used by one process
+            sensors = set(function.hub for function in functions
+                          if isinstance(function, YocotpuceBinding))
+            functions = [function for function in functions
+                         if isinstance(function, YoctopuceActuator)]
+            if any(function.hub == 'usb' and function.backend == 'yoctopuce'
+                   for function in functions) and 'usb' in sensors:
+                raise ValueError("USB actuators and sensors can not be used in separate "
+                                 "processes, use a VirtualHub")
+        # only the hubs actually hosting a real function of the map are used
+        used = [function.hub for function in functions if function.backend == 'yoctopuce']
+        hub_urls = [url for url in self.hubs if url in used]
+        for url in used:
+            if url not in hub_urls:
+                hub_urls.append(url)
+        register_hubs([url for url in hub_urls if url not in self._registered])
+        self._registered.update(hub_urls)
+
+    def build(self, previous):
+        """ Read the device map and build the data block and slave context
+        of each of its units
+
+        :param previous: The DeviceMapVersion currently served, whose
+                         bindings and actuators are reused for the lines
+                         that did not change
+        :returns: A new DeviceMapVersion
+        """
+        functions = {}
+        lines = {}
+        single = True
+        for regno, hwid, encoding, options in parse_device_map(self.map_path, self.hubs[0],
+                                                               self.backend):
+            line = (regno, hwid, encoding, tuple(sorted(options.items())))
+            unit_id = options.pop('unit', None)
+            if unit_id is None:
+                unit_id = DEFAULT_UNIT
+            else:
+                single = False
+                unit_id = int(unit_id, 0)
+                if not 0 <= unit_id <= 247:
+                    raise ValueError("unit id of %s must be between 0 and 247" % hwid)
+            function = previous.functions.get(line)
+            if function is None:
+                if encoding in ACTUATORS:
+                    function = YoctopuceActuator(regno, hwid, encoding, **options)
+                else:
+                    function = YocotpuceBinding(regno, hwid, encoding, **options)
+                    # how an acquisition process creates it again
+                    function.definition = (regno, hwid, encoding, options)
+            functions[line] = function
+            devices, actuators = lines.setdefault(unit_id, ({}, {}))
+            if encoding in ACTUATORS:
+                actuators[regno] = function
+            else:
+                devices[regno] = function
+        if not lines:
+            lines[DEFAULT_UNIT] = ({}, {})
+        self._register_hubs(functions.values())
+
+        units = {}
+        for unit_id, (devices, actuators) in lines.items():
+            units[unit_id] = self._build_unit(devices, actuators)
+        return DeviceMapVersion(functions, units, single)
+
+    def _build_unit(self, devices, actuators):
+        block = create_block(devices, self.image, self.acquisition == 'snapshot',
+                             self.acquisition == 'process')
+        block.read_pool = self.read_pool
+        for binding in devices.values():
+            if binding.value is not None:
+                block.store(binding, binding.value)
+        if actuators and self.writer is None:
+            self.writer = YoctopuceWriter({})
+            self.writer.start()
+        slave = build_slave_context(block, self.layout, actuators, self.writer)
+        if self.metrics is not None:
+            if self.layout == 'split':
+                self.metrics.instrument_block(slave.store['i'], 'ir')
+                self.metrics.instrument_block(slave.store['d'], 'di')
+                self.metrics.instrument_block(slave.store['h'], 'hr')
+            else:
+                self.metrics.instrument_block(block)
+        if self.response_cache:
+            block.responses = ResponseCache(block)
+            if self.metrics is not None:
+                self.metrics.instrument_cache(block.responses,
+                                              'ir' if self.layout == 'split' else 'shared')
+        return ModbusUnit(devices, actuators, block, slave)
+
+    def _check(self, version):
+        """ Tell if a new version of the map can be served in place of the
+        current one: the server context is created single or multi unit
+        """
+        if version.single != self.current.single:
+            log.error("unable to reload %s: adding or removing the unit column "
+                      "requires a restart" % self.map_path)
+            return False
+        return True
+
+    def _install(self, version, workers, retired):
+        previous = self.current
+        if version.single:
+            self.context[DEFAULT_UNIT] = version.units[DEFAULT_UNIT].slave
+        else:
+            # each unit is swapped at once, the new ones added first
+            for unit_id, unit in version.units.items():
+                self.context[unit_id] = unit.slave
+            for unit_id in self.context.slaves():
+                if unit_id not in version.units:
+                    del self.context[unit_id]
+        self.current = version
+        self.workers = workers
+        if self.writer is not None:
+            self.writer.update(version.actuators())
+        stop_workers(retired)
+        if previous is not version:
+            for block in previous.blocks():
+                block.close()
+
+    def _retire(self):
+        # the new event pump registers the callbacks of the reused sensors
+        # again, the old one must not unregister them afterwards, and the
+        # new acquisition processes open the hubs the old ones hold, which
+        # fails for USB, usable by a single process
+        if self.acquisition in ('event', 'process'):
+            stop_workers(self.workers)
+            return []
+        # the pollers keep the old map fresh until the new one is served
+        return self.workers
+
+    def start(self):
+        """ Start the acquisition of the device map
+        """
+        workers = start_acquisition(self.current.blocks(), self.acquisition,
+                                    self.idle, self.idle_period, self.prefetch)
+        self._install(self.current, workers, [])
+
+    def reload(self):
+        """ Rebuild the data store from the device map and serve it. On
+        error the current map keeps being served.
+        """
+        try:
+            version = self.build(self.current)
+        except Exception as ex:
+            log.error("unable to reload %s: %s" % (self.map_path, ex))
+            return
+        if not self._check(version):
+            return
+        retired = self._retire()
+        workers = start_acquisition(version.blocks(), self.acquisition,
+                                    self.idle, self.idle_period, self.prefetch)
+        self._install(version, workers, retired)
+        log.info("reloaded %s: %s" % (self.map_path, version.describe()))
+
+    async def _start_async(self, blocks):
+        if self.acquisition != 'poll':
+            # waits for the first pass of the workers, off the event loop
+            return await asyncio.get_event_loop().run_in_executor(
+                None, start_acquisition, blocks, self.acquisition, self.idle,
+                self.idle_period, self.prefetch)
+        tasks = []
+        ready = []
+        for block in blocks:
+            for hub, devices in group_by_hub(block.devices).items():
+                # a single worker thread per hub keeps its YAPI calls serialized
+                if hub not in self._executors:
+                    self._executors[hub] = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="yoctopuce-%s" % hub)
+                ready.append(asyncio.Event())
+                tasks.append(asyncio.ensure_future(
+                    poll_sensors(block, devices, self._executors[hub], ready[-1],
+                                 self.idle, self.idle_period, self.prefetch)))
+        try:
+            await asyncio.wait_for(asyncio.gather(*[event.wait() for event in ready]),
+                                   STARTUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning("some hubs are not ready yet")
+        return tasks
+
+    async def start_async(self):
+        """ The asyncio flavour of start(): the sensors of each hub are
+        polled by a task reading them in a dedicated executor thread.
+        """
+        workers = await self._start_async(self.current.blocks())
+        self._install(self.current, workers, [])
+
+    async def reload_async(self):
+        """ The asyncio flavour of reload(), to run on the event loop
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            version = await loop.run_in_executor(None, self.build, self.current)
+        except Exception as ex:
+            log.error("unable to reload %s: %s" % (self.map_path, ex))
+            return
+        if not self._check(version):
+            return
+        retired = await loop.run_in_executor(None, self._retire)
+        workers = await self._start_async(version.blocks())
+        # the worker threads are joined off the event loop, possibly
+        # waiting for a sensor read, the poll tasks cancelled on it
+        tasks = [worker for worker in retired if isinstance(worker, asyncio.Future)]
+        threads = [worker for worker in retired if worker not in tasks]
+        await loop.run_in_executor(None, self._install, version, workers, threads)
+        stop_workers(tasks)
+        log.info("reloaded %s: %s" % (self.map_path, version.describe()))
+
+
+class DeviceMapWatcher(threading.Thread):
+    """ A thread polling the modification time of the device map and
+    calling on_change when it changes. Polling the file works on every
+    platform and file system, unlike inotify.
+    """
+
+    def __init__(self, path, on_change, interval=1.0):
+        super(DeviceMapWatcher, self).__init__(name="device-map-watcher")
+        self.daemon = True
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._halt = threading.Event()
+
+    def _signature(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def run(self):
+        try:
+            signature = self._signature()
+        except OSError:
+            # reloaded once the file is back
+            signature = None
+        while not self._halt.wait(self.interval):
+            try:
+                current = self._signature()
+            except OSError:
+                # the file is being replaced, look again later
+                continue
+            if current != signature:
+                signature = current
+                log.info("%s changed, reloading" % self.path)
+                self.on_change()
+
+    def stop(self):
+        self._halt.set()
 
 
 # ----------------------------------------------------------------------- #
 # initialize your data store
 # ----------------------------------------------------------------------- #
-def run_callback_server():
-    errmsg = YRefParam()
+async def serve_asyncio(store, identity, address, reload_interval=None, custom_functions=(),
+                        fast_reads=False):
+    """ Run the Modbus TCP server on an asyncio event loop
+
+    :param store: The YoctopuceStore to serve
+    :param identity: The ModbusDeviceIdentification of the server
+    :param address: The (host, port) to listen on
+    :param reload_interval: Reload the device map when it changes,
+                            checking it every reload_interval seconds
+    :param custom_functions: Request classes overriding the pymodbus ones
+    :param fast_reads: Serve the register reads with a FastReadPath
+    """
+    # imported here so that the twisted server does not need the
+    # asyncio dependencies of pymodbus (pyserial-asyncio)
+    from pymodbus.server.async_io import StartTcpServer as StartAsyncTcpServer
+    from pymodbus.server.async_io import ModbusConnectedRequestHandler
+
+    class FastReadRequestHandler(ModbusConnectedRequestHandler):
+
+        def connection_made(self, transport):
+            super(FastReadRequestHandler, self).connection_made(transport)
+            self.fast_reads = FastReadPath(self.server.context, transport)
+
+        def data_received(self, data):
+            # while pymodbus has frames to answer, the next ones wait for them
+            if self.receive_queue.empty() and not self.framer._buffer:
+                data = self.fast_reads.feed(data)
+            if data:
+                super(FastReadRequestHandler, self).data_received(bytes(data))
 
-    # Setup the API to use local USB devices
-    if YAPI.RegisterHub("usb", errmsg) != YAPI.SUCCESS:
-        sys.exit("init error" + str(errmsg))
+    await store.start_async()
+    if reload_interval:
+        loop = asyncio.get_event_loop()
+        DeviceMapWatcher(store.map_path, lambda: asyncio.run_coroutine_threadsafe(
+            store.reload_async(), loop).result(), reload_interval).start()
+    # requests to a unit id absent from a multi unit map are not answered
+    server = await StartAsyncTcpServer(store.context, identity=identity, address=address,
+                                       custom_functions=list(custom_functions),
+                                       ignore_missing_slaves=True,
+                                       handler=FastReadRequestHandler if fast_reads else None,
+                                       defer_start=True, backlog=512)
+    await server.serve_forever()
 
+
+def run_callback_server(map_path="device-mapping.txt", acquisition='poll', image=False,
+                        server='twisted', hubs=("usb",), backend=None,
+                        address=("localhost", 5020), metrics_port=None, layout='shared',
+                        reload_interval=None, read_threads=0, idle=0, idle_period=0,
+                        prefetch=False, response_cache=False, fast_reads=False):
     # ----------------------------------------------------------------------- #
     # initialize your data store
     # ----------------------------------------------------------------------- #
-    queue = Queue()
-    devices = read_device_map("device-mapping.txt")
-
-    block = YoctopuceDataBlock(devices)
-    store = ModbusSlaveContext(di=block, co=block, hr=block, ir=block, zero_mode=True)
-    context = ModbusServerContext(slaves=store, single=True)
+    metrics = None
+    if metrics_port:
+        metrics = Metrics()
+    store = YoctopuceStore(map_path, acquisition, image, layout, hubs, backend, metrics,
+                           read_threads, idle, idle_period, prefetch, response_cache)
+    if metrics is not None:
+        serve_metrics(metrics, metrics_port)
 
     # ----------------------------------------------------------------------- #
     # initialize the server information
@@ -170,8 +3134,92 @@ def run_callback_server():
     identity.ModelName = 'ypymodbus Server'
     identity.MajorMinorRevision = '0.0.1'
 
-    StartTcpServer(context, identity=identity, address=("localhost", 5020))
+    # register reads served from the response caches of the blocks
+    custom_functions = CACHED_REQUESTS if response_cache else []
+    if fast_reads and server != 'asyncio':
+        sys.exit("fast register reads require the asyncio server")
+    if server == 'asyncio':
+        if acquisition == 'sync':
+            sys.exit("sync acquisition would block the asyncio event loop")
+        asyncio.run(serve_asyncio(store, identity, address, reload_interval, custom_functions,
+                                  fast_reads))
+        return
+    store.start()
+    if reload_interval:
+        DeviceMapWatcher(map_path, store.reload, reload_interval).start()
+    # requests to a unit id absent from a multi unit map are not answered
+    if server == 'threaded':
+        # one thread per client, concurrent reads of a sensor are coalesced
+        from pymodbus.server.sync import StartTcpServer as StartThreadedTcpServer
+        StartThreadedTcpServer(store.context, identity=identity, address=address,
+                               custom_functions=custom_functions, ignore_missing_slaves=True)
+    else:
+        StartTcpServer(store.context, identity=identity, address=address,
+                       custom_functions=custom_functions, ignore_missing_slaves=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Modbus TCP server for Yoctopuce sensors")
+    parser.add_argument("--map", default="device-mapping.txt",
+                        help="device mapping file (default: %(default)s)")
+    parser.add_argument("--acquisition", choices=("poll", "snapshot", "process", "event", "sync"),
+                        default="poll",
+                        help="poll the sensors in background, poll all the sensors of "
+                             "a module at once and publish consistent snapshots, poll "
+                             "them from a process per hub, let them push their values, "
+                             "or read them on each request (default: %(default)s)")
+    parser.add_argument("--image", action="store_true",
+                        help="store the registers in a contiguous byte image")
+    parser.add_argument("--server", choices=("twisted", "asyncio", "threaded"), default="twisted",
+                        help="network framework of the Modbus server (default: %(default)s)")
+    parser.add_argument("--hub", action="append", dest="hubs",
+                        help="url of a hub to use, may be repeated; bindings without "
+                             "hub option use the first one (default: usb)")
+    parser.add_argument("--backend",
+                        help="sensor backend of the bindings without backend option, "
+                             "e.g. sim?latency=0.01&failure=0.05 to simulate every sensor")
+    parser.add_argument("--host", default="localhost",
+                        help="interface to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=5020,
+                        help="TCP port to listen on (default: %(default)s)")
+    parser.add_argument("--log-level", default="DEBUG",
+                        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="logging level (default: %(default)s)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on http://localhost:PORT/metrics")
+    parser.add_argument("--layout", choices=("shared", "split"), default="shared",
+                        help="serve the measures in every table, or split them into "
+                             "measures (input registers), alarms (discrete inputs) and "
+                             "refresh periods (holding registers) (default: %(default)s)")
+    parser.add_argument("--reload", type=float, nargs="?", const=1.0, metavar="SECONDS",
+                        help="reload the device map when it changes, checking it "
+                             "every SECONDS (default: 1)")
+    parser.add_argument("--read-threads", type=int, default=0,
+                        help="with sync acquisition, read the sensors of different "
+                             "modules concurrently with this many threads "
+                             "(default: %(default)s, one after the other)")
+    parser.add_argument("--idle", type=float, default=0, metavar="SECONDS",
+                        help="stop polling the sensors no request read for SECONDS, "
+                             "until they are read again (default: 0, poll every sensor)")
+    parser.add_argument("--idle-refresh", type=float, default=0, metavar="SECONDS",
+                        help="poll the idle sensors every SECONDS instead of stopping")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="refresh the sensors read periodically just before "
+                             "the next read expected from their clients")
+    parser.add_argument("--response-cache", action="store_true",
+                        help="cache the encoded responses of the register reads until "
+                             "their registers change")
+    parser.add_argument("--fast-reads", action="store_true",
+                        help="serve the register reads straight from the register image "
+                             "(with --server asyncio and --image or snapshot acquisition)")
+    args = parser.parse_args()
+    log.setLevel(args.log_level)
+    run_callback_server(args.map, args.acquisition, args.image, args.server,
+                        args.hubs or ["usb"], args.backend, (args.host, args.port),
+                        args.metrics_port, args.layout, args.reload, args.read_threads,
+                        args.idle, args.idle_refresh, args.prefetch, args.response_cache,
+                        args.fast_reads)
 
 
 if __name__ == "__main__":
-    run_callback_server()
+    main()